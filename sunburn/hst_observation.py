@@ -9,32 +9,47 @@ from __future__ import (division, print_function, absolute_import,
 
 import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.pylab as pylab
 import astropy.units as u
 import astropy.constants as c
 import astropy.uncertainty as a_unc
 import os
+import re
 import glob
-import emcee
 
 
 from warnings import warn
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits
 from astropy.time import Time
 from astropy.stats import poisson_conf_interval
 from . import tools, spectroscopy
-from scipy.integrate import simps
+from numpy.polynomial import Polynomial
 from scipy.interpolate import interp1d
 from scipy.optimize import minimize
 from scipy.stats import binned_statistic
-from costools import splittag, x1dcorr
-from stistools import inttag
-from calcos.x1d import concatenateSegments
+
+# ``fitsio`` is an optional dependency, used to read the x1d files faster
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
 
 __all__ = ["Visit", "UVSpectrum", "COSSpectrum", "STISSpectrum",
            "CombinedSpectrum", "SpectralLine", "ContaminatedLine",
            "AirglowTemplate"]
 
+# Random number generator used to draw the bootstrap samples
+_RNG = np.random.default_rng()
+
+# Speed of light in km / s
+_LS_KMS = c.c.to(u.km / u.s).value
+
+# Filenames of the COS time-tag split files, with the detector segment after
+# or before the file type (e.g., ``foo_1_corrtag_a.fits`` and
+# ``foo_1_a_corrtag.fits``)
+_SEGMENT_LAST = re.compile(r'_(\d)_corrtag_([ab])\.fits$')
+_SEGMENT_FIRST = re.compile(r'_(\d)_([ab])_(corrtag|x1d)\.fits$')
+
 
 # HST visit
 class Visit(object):
@@ -55,9 +70,14 @@ class Visit(object):
             limits of the detector, with shape (2, 2), where the first line is
             the limits for the red chip, and the second line is for the blue
             chip. If ``None``, use all pixels. Default is ``None``.
+
+        n_threads (``int``, optional): Maximum number of threads used to read
+            the orbits in parallel. If ``None``, use the default of
+            ``concurrent.futures.ThreadPoolExecutor``. Default is ``None``.
     """
     def __init__(self, dataset_name, instrument, good_pixel_limits=None,
-                 prefix=None, compute_proper_error=True, flux_debias=None):
+                 prefix=None, compute_proper_error=True, flux_debias=None,
+                 n_threads=None):
 
         self.orbit = {}
         self.split = {}
@@ -70,25 +90,133 @@ class Visit(object):
         self.prefix = prefix
         self.dataset_names = dataset_name
 
-        for i in range(len(dataset_name)):
-            # Instantiate the orbit classes
+        # Instantiate the orbit classes. Reading the orbits is mostly I/O
+        # bound, so it is done in parallel threads
+        def _make_orbit(i):
             if instrument == 'cos':
-                self.orbit[dataset_name[i]] = \
-                    COSSpectrum(dataset_name[i], good_pixel_limits,
-                                prefix=prefix)
+                orbit = COSSpectrum(dataset_name[i], good_pixel_limits,
+                                    prefix=prefix)
                 if compute_proper_error is True:
-                    self.orbit[dataset_name[i]].compute_proper_error()
+                    orbit.compute_proper_error()
                 else:
                     pass
                 if isinstance(flux_debias, float):
-                    self.orbit[dataset_name[i]].flux *= flux_debias
+                    debias = flux_debias
                 elif isinstance(flux_debias, np.ndarray):
-                    self.orbit[dataset_name[i]].flux *= flux_debias[i]
+                    debias = flux_debias[i]
                 else:
-                    pass
+                    debias = None
+                # The fluxes of each chip are views of the x1d data, so they
+                # are rescaled into new arrays instead of in place
+                if debias is not None:
+                    orbit.flux = [chip * debias for chip in orbit.flux]
             elif instrument == 'stis':
-                self.orbit[dataset_name[i]] = \
-                    STISSpectrum(dataset_name[i], prefix=prefix)
+                orbit = STISSpectrum(dataset_name[i], prefix=prefix)
+            else:
+                orbit = None
+            return orbit
+
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            orbits = list(executor.map(_make_orbit, range(self.n_orbit)))
+        for name, orbit in zip(dataset_name, orbits):
+            if orbit is not None:
+                self.orbit[name] = orbit
+
+        # Stacked spectra of all orbits (only for COS). They are only built
+        # when they are first needed, so that the orbits keep their lazily
+        # loaded views of the x1d data until then
+        self.wavelength = None
+        self.flux = None
+        self.error = None
+
+    # Store the spectra of all orbits in arrays shared with the orbits
+    def _stack_orbits(self):
+        """
+        Stack the wavelengths, fluxes and uncertainties of all orbits in the
+        visit in arrays with shape (n_orbit, n_pixels), one for each chip of the
+        detector. The arrays of each orbit are then replaced by views of the
+        stacked arrays, so that the data are stored only once.
+        """
+        orbits = [self.orbit[name] for name in self.dataset_names]
+        self.wavelength = [np.stack([orbit.wavelength[k] for orbit in orbits])
+                           for k in range(2)]
+        self.flux = [np.stack([orbit.flux[k] for orbit in orbits])
+                     for k in range(2)]
+        self.error = [np.stack([orbit.error[k] for orbit in orbits])
+                      for k in range(2)]
+        for i, orbit in enumerate(orbits):
+            orbit.wavelength = [self.wavelength[k][i] for k in range(2)]
+            orbit.flux = [self.flux[k][i] for k in range(2)]
+            orbit.error = [self.error[k][i] for k in range(2)]
+
+    # Check if the arrays of the orbits are still views of the stacked arrays
+    def _is_stacked(self):
+        """
+        Check if the fluxes and uncertainties of all orbits are still stored in
+        the stacked arrays of the visit. This is not the case if they were
+        replaced after stacking (e.g., by a systematics correction).
+
+        Returns:
+            stacked (``bool``): ``True`` if the stacked arrays are up to date.
+        """
+        if self.flux is None:
+            return False
+        return all(orbit.flux[k].base is self.flux[k] and
+                   orbit.error[k].base is self.error[k]
+                   for orbit in self.orbit.values() for k in range(2))
+
+    # Compute the integrated flux of all orbits in a given wavelength range
+    def integrated_flux(self, wavelength_range):
+        """
+        Compute the integrated flux of all the orbits in the visit (only for
+        COS) in a user-defined wavelength range, with uncertainties computed as
+        a quadratic sum. The fluxes of all orbits are integrated at once.
+
+        Args:
+
+            wavelength_range (array-like): Lower and upper bounds of the
+                wavelength limits.
+
+        Returns:
+
+            int_flux (``numpy.array``): Integrated fluxes of the orbits, in the
+                same order as ``dataset_names``.
+
+            uncertainty (``numpy.array``): Uncertainties of the integrated
+                fluxes.
+        """
+        if self.instrument != 'cos':
+            raise ValueError('Integrating the fluxes of all orbits at once is '
+                             'only available for COS.')
+        elif self._is_stacked() is False:
+            self._stack_orbits()
+        else:
+            pass
+
+        # Build, for each orbit, the integration weights and the widths of the
+        # wavelength bins, which are zero outside of the wavelength range
+        slices = [self.orbit[name]._slice(wavelength_range)
+                  for name in self.dataset_names]
+        ind = slices[0][0]
+        if any(sk[0] != ind for sk in slices):
+            raise ValueError('The requested wavelength range falls in '
+                             'different chips for different orbits.')
+        wavelength = self.wavelength[ind]
+        weights = np.zeros_like(wavelength)
+        unc_weights = np.zeros_like(wavelength)
+        for i, (name, sk) in enumerate(zip(self.dataset_names, slices)):
+            min_wl = sk[1]
+            max_wl = sk[2] + 1
+            weights[i, min_wl:max_wl] = \
+                self.orbit[name]._simpson_weights(ind, min_wl, max_wl)
+            delta_wl = self.orbit[name]._delta_wl[ind][min_wl:max_wl]
+            unc_weights[i, min_wl:min_wl + len(delta_wl)] = delta_wl
+
+        int_flux = np.einsum('ij,ij->i', weights, self.flux[ind])
+        uncertainty = np.sqrt(np.einsum('ij,ij,ij,ij->i', unc_weights,
+                                        unc_weights, self.error[ind],
+                                        self.error[ind]))
+        return int_flux, uncertainty
 
     # Plot all the spectra in a wavelength range
     def plot_spectra(self, wavelength_range=None, velocity_range=None,
@@ -124,13 +252,44 @@ class Visit(object):
             legend_font_size (``int``, optional): Font size of the legend.
                 Default value is 13.
         """
-        pylab.rcParams['figure.figsize'] = figure_sizes[0], figure_sizes[1]
-        pylab.rcParams['font.size'] = axes_font_size
+        plt.rcParams['figure.figsize'] = figure_sizes[0], figure_sizes[1]
+        plt.rcParams['font.size'] = axes_font_size
 
         x_axis_return = []
         y_axis_return = []
         y_err_return = []
 
+        # Compute the wavelength shift correction
+        if ref_wl is not None:
+            wl_shift = ref_wl * doppler_shift_corr / _LS_KMS
+        else:
+            wl_shift = 0.0
+
+        # Use either the wavelength range or the chip_index
+        if wavelength_range is None and velocity_range is None:
+            k = chip_index
+            first_orbit = self.orbit[self.dataset_names[0]]
+            try:
+                wavelength_range = [min(first_orbit.wavelength[k]) + 1,
+                                    max(first_orbit.wavelength[k]) - 1]
+            except TypeError:
+                raise ValueError('Either the wavelength range or the chip'
+                                 'index have to be provided.')
+        else:
+            pass
+
+        if velocity_range is not None:
+            vi = velocity_range[0]
+            vf = velocity_range[1]
+            ls = _LS_KMS
+            wavelength_range = (vi / ls * ref_wl + ref_wl,
+                                vf / ls * ref_wl + ref_wl)
+
+        # The bounds in the rest frame of the spectra are the same for all the
+        # orbits, and the indexes of each orbit are cached by ``_slice``
+        shifted_range = (wavelength_range[0] - wl_shift,
+                         wavelength_range[1] - wl_shift)
+
         for i in self.orbit:
             if isinstance(labels, str):
                 label = labels
@@ -140,35 +299,10 @@ class Visit(object):
                 # Use the start time of observation as label
                 label = self.orbit[i].start_JD.iso
 
-            # Compute the wavelength shift correction
-            if ref_wl is not None:
-                wl_shift = ref_wl * doppler_shift_corr / c.c.to(u.km / u.s).value
-            else:
-                wl_shift = 0.0
-
-            # Use either the wavelength range or the chip_index
-            if wavelength_range is None and velocity_range is None:
-                k = chip_index
-                try:
-                    wavelength_range = [min(self.orbit[i].wavelength[k]) + 1,
-                                        max(self.orbit[i].wavelength[k]) - 1]
-                except TypeError:
-                    raise ValueError('Either the wavelength range or the chip'
-                                     'index have to be provided.')
-            else:
-                pass
-
-            if velocity_range is not None:
-                vi = velocity_range[0]
-                vf = velocity_range[1]
-                ls = c.c.to(u.km / u.s).value
-                wavelength_range = (vi / ls * ref_wl + ref_wl,
-                                    vf / ls * ref_wl + ref_wl)
-
-            # Find which side of the chip corresponds to the wavelength range
-            # (only for COS)
-            if self.instrument == 'cos':
-                ind = tools.pick_side(self.orbit[i].wavelength, wavelength_range)
+            # Find which side of the chip (only for COS) and which spectrum
+            # indexes correspond to the requested wavelength range
+            ind, min_wl, max_wl = self.orbit[i]._slice(shifted_range)
+            if ind is not None:
                 wavelength = self.orbit[i].wavelength[ind]
                 flux = self.orbit[i].flux[ind]
                 f_unc = self.orbit[i].error[ind]
@@ -178,17 +312,9 @@ class Visit(object):
                 flux = self.orbit[i].flux
                 f_unc = self.orbit[i].error
 
-            # Now find which spectrum indexes correspond to the requested
-            # wavelength
-            min_wl = tools.nearest_index(wavelength,
-                                         wavelength_range[0] - wl_shift)
-            max_wl = tools.nearest_index(wavelength,
-                                         wavelength_range[1] - wl_shift)
-
             if velocity_space is True:
-                x_axis = \
-                    (wavelength[min_wl:max_wl] + wl_shift -
-                     ref_wl) / ref_wl * c.c.to(u.km / u.s).value
+                x_axis = wavelength[min_wl:max_wl] - (ref_wl - wl_shift)
+                x_axis *= _LS_KMS / ref_wl
                 x_label = r'Velocity (km s$^{-1}$)'
             else:
                 x_axis = wavelength[min_wl:max_wl] + wl_shift
@@ -281,6 +407,17 @@ class UVSpectrum(object):
             the units will be set to angstrom, erg/s/cm**2/angstrom and s for
             the wavelength, flux and exposure time. Default is ``None``.
     """
+    # Spectral data, which are set by the instrument-specific subclasses
+    wavelength = None
+    flux = None
+    error = None
+    quality = None
+    gross_counts = None
+    background = None
+    net = None
+    # Columns of the x1d table read by ``fitsio``; if ``None``, read all
+    _x1d_columns = None
+
     def __init__(self, dataset_name, good_pixel_limits=None, units=None,
                  prefix=None):
 
@@ -302,9 +439,16 @@ class UVSpectrum(object):
         else:
             self.prefix = prefix
 
-        # Read data from x1d file
-        with fits.open(self.prefix + self.x1d) as f:
-            self.data = f['SCI'].data
+        # Read data from x1d file. If ``fitsio`` is installed, it is used to
+        # read only the columns used by the subclass; otherwise the file is
+        # memory-mapped with ``astropy``, so the columns are only read from
+        # disk when they are used
+        if fitsio is not None:
+            self.data = fitsio.read(self.prefix + self.x1d, ext='SCI',
+                                    columns=self._x1d_columns)
+        else:
+            with fits.open(self.prefix + self.x1d, memmap=True) as f:
+                self.data = f['SCI'].data
 
         # If ``good_pixel_limits`` is set to ``None``, then the data will be
         # retrieved from the file in its entirety. Otherwise, it will be
@@ -322,14 +466,80 @@ class UVSpectrum(object):
         self.start_JD = None
         self.end_JD = None
         self.exp_time = None
-        self.wavelength = None
-        self.flux = None
-        self.net = None
-        self.gross_counts = None
-        self.error = None
-        self.quality = None
+        self._delta_wl = None  # Wavelength bin widths
+        self._chip_limits = None  # First and last wavelengths of each chip
         self.slit_orientation = None
 
+        # Cache of the chip and indexes found for each wavelength range, and
+        # of the integration weights of each slice
+        self._slices = {}
+        self._weights = {}
+
+    # Find the chip and the indexes corresponding to a wavelength range
+    def _slice(self, wavelength_range):
+        """
+        Find which chip (only for COS) and which indexes of the spectrum
+        correspond to a wavelength range. The results are cached, so repeated
+        calls with the same wavelength range do not search the wavelength
+        array again.
+
+        Args:
+
+            wavelength_range (array-like): Lower and upper bounds of the
+                wavelength limits.
+
+        Returns:
+
+            ind (``int`` or ``None``): Index of the chip where the wavelength
+                range falls into, or ``None`` if the instrument is not COS.
+
+            min_wl (``int``): Index of the lower bound of the wavelength range.
+
+            max_wl (``int``): Index of the upper bound of the wavelength range.
+        """
+        key = (wavelength_range[0], wavelength_range[1])
+        if key not in self._slices:
+            if self.instrument == 'cos':
+                ind = tools.pick_side(self._chip_limits, wavelength_range)
+                wavelength = self.wavelength[ind]
+            else:
+                ind = None
+                wavelength = self.wavelength
+            # Both bounds are searched in a single (binary search) call
+            min_wl, max_wl = tools.nearest_index(wavelength, np.array(key))
+            self._slices[key] = (ind, min_wl, max_wl)
+        return self._slices[key]
+
+    # Simpson's rule weights of the wavelength grid in a slice of the spectrum
+    def _simpson_weights(self, ind, min_wl, max_wl):
+        """
+        Compute the Simpson's rule weights of the wavelength grid between the
+        indexes ``min_wl`` and ``max_wl`` (exclusive), such that the integral
+        of the flux in this slice is the dot product between the weights and
+        the flux. The results are cached for each slice.
+
+        Args:
+
+            ind (``int`` or ``None``): Index of the chip (only for COS).
+
+            min_wl (``int``): Index of the lower bound of the slice.
+
+            max_wl (``int``): Index of the upper bound of the slice.
+
+        Returns:
+
+            weights (``numpy.array``): Integration weights.
+        """
+        key = (ind, min_wl, max_wl)
+        if key not in self._weights:
+            if ind is not None:
+                wavelength = self.wavelength[ind]
+            else:
+                wavelength = self.wavelength
+            self._weights[key] = \
+                tools.simpson_weights(wavelength[min_wl:max_wl])
+        return self._weights[key]
+
     # Compute the integrated flux in a given wavelength range
     def integrated_flux(self, wavelength_range=None, velocity_range=None,
                         reference_wl=None, rv_correction=0.0,
@@ -357,64 +567,61 @@ class UVSpectrum(object):
                 flux.
         """
         ls = c.c.to(u.km / u.s)
-        if wavelength_range is not None:
-            if self.instrument == 'cos':
-                ind = tools.pick_side(self.wavelength, wavelength_range)
-                wavelength = self.wavelength[ind]
-                flux = self.flux[ind]
-                net = self.net[ind]
-                gross = self.gross_counts[ind]
-                f_unc = self.error[ind]
-            else:
-                wavelength = self.wavelength
-                flux = self.flux
-                net = self.net
-                gross = self.gross_counts
-                f_unc = self.error
-        else:
+        if wavelength_range is None:
             assert(reference_wl is not None and velocity_range is not None,
                    'Reference wavelength and RV range must be provided '
                    'if you did not pick a wavelength range.')
             velocity_range += rv_correction
             wavelength_range = velocity_range * reference_wl / ls + reference_wl
-            if self.instrument == 'cos':
-                ind = tools.pick_side(self.wavelength, wavelength_range)
-                wavelength = self.wavelength[ind]
-                flux = self.flux[ind]
-                net = self.net[ind]
-                gross = self.gross_counts[ind]
-                f_unc = self.error[ind]
-            else:
-                wavelength = self.wavelength
-                flux = self.flux
-                net = self.net
-                gross = self.gross_counts
-                f_unc = self.error
+        else:
+            pass
+
+        ind, min_wl, max_wl = self._slice(wavelength_range)
+        max_wl += 1
+        if ind is not None:
+            wavelength = self.wavelength[ind]
+            delta_wl = self._delta_wl[ind]
+            flux = self.flux[ind]
+            net = self.net[ind]
+            gross = self.gross_counts[ind]
+            f_unc = self.error[ind]
+        else:
+            wavelength = self.wavelength
+            delta_wl = self._delta_wl
+            flux = self.flux
+            net = self.net
+            gross = self.gross_counts
+            f_unc = self.error
 
-        min_wl = tools.nearest_index(wavelength, wavelength_range[0])
-        max_wl = tools.nearest_index(wavelength, wavelength_range[1]) + 1
+        # Only the slices inside the wavelength range are used from now on
+        wavelength = wavelength[min_wl:max_wl]
+        delta_wl = delta_wl[min_wl:max_wl]
+        flux = flux[min_wl:max_wl]
+        f_unc = f_unc[min_wl:max_wl]
+        net = net[min_wl:max_wl]
+        gross = gross[min_wl:max_wl]
 
-        # The following line is hacky, but it works
-        delta_wl = wavelength[1:] - wavelength[:-1]
+        # Simpson's rule weights for the wavelength grid being integrated
+        weights = self._simpson_weights(ind, min_wl, max_wl)
         if integrate_choice is 'flux':
-            int_flux = simps(flux[min_wl:max_wl], x=wavelength[min_wl:max_wl])
+            int_flux = np.dot(weights, flux)
         elif integrate_choice is 'counts':
-            int_flux = np.sum(gross[min_wl:max_wl])
+            int_flux = np.sum(gross)
             uncertainty_method = 'poisson'
         elif integrate_choice is 'net':
-            int_flux = np.sum(net[min_wl:max_wl])
+            int_flux = np.sum(net)
             uncertainty_method = 'poisson'
         else:
             raise ValueError('This integration choice is not implemented.')
 
         # Compute the uncertainty of the integrated flux
         if uncertainty_method == 'quadratic_sum':
-            uncertainty = np.sqrt(np.sum((delta_wl[min_wl:max_wl] *
-                                          f_unc[min_wl:max_wl]) ** 2))
+            uncertainty = np.sqrt(np.einsum('i,i,i,i->', delta_wl, delta_wl,
+                                            f_unc, f_unc))
         elif uncertainty_method == 'poisson':
-            sensitivity = flux[min_wl:max_wl] / net[min_wl:max_wl]
-            mean_sensitivity = np.nanmean(sensitivity * delta_wl[min_wl:max_wl])
-            int_gross = np.sum(gross[min_wl:max_wl])
+            sensitivity = flux / net
+            mean_sensitivity = np.nanmean(sensitivity * delta_wl)
+            int_gross = np.sum(gross)
             gross_unc = poisson_conf_interval(int(int_gross),
                                               interval='root-n') - int_gross
             if integrate_choice is 'flux':
@@ -428,15 +635,24 @@ class UVSpectrum(object):
                 raise ValueError('This integration choice is not implemented.')
         elif uncertainty_method == 'bootstrap':
             n_samples = 10000
-            # Draw a sample of spectra and compute the fluxes for each
-            samples = np.random.normal(loc=flux[min_wl:max_wl],
-                                       scale=f_unc[min_wl:max_wl],
-                                       size=[n_samples, max_wl - min_wl])
-            fluxes = []
-            for i in range(n_samples):
-                fluxes.append(simps(samples[i],
-                                    x=wavelength[min_wl:max_wl]))
-            fluxes = np.array(fluxes)
+            chunk_size = 512
+            # Draw a sample of spectra and compute the fluxes for each. The
+            # samples are drawn in chunks that reuse the same buffer, so the
+            # whole sample is never held in memory at once
+            # The samples are drawn in single precision, which is the
+            # precision of the fluxes in the x1d files
+            # The integral is linear in the flux, so the flux of each sample is
+            # ``int_flux`` plus the integral of its noise, and only the
+            # normalized noise needs to be drawn
+            noise_weights = (weights * f_unc).astype(np.float32)
+            fluxes = np.empty(n_samples)
+            buffer = np.empty((chunk_size, len(flux)), dtype=np.float32)
+            for start in range(0, n_samples, chunk_size):
+                stop = min(start + chunk_size, n_samples)
+                samples = buffer[:stop - start]
+                _RNG.standard_normal(out=samples, dtype=np.float32)
+                fluxes[start:stop] = samples.dot(noise_weights)
+            fluxes += int_flux
             uncertainty = np.std(fluxes)
         else:
             raise ValueError('This value of ``uncertainty_method`` is not '
@@ -461,13 +677,13 @@ class UVSpectrum(object):
                 is not None:
             velocity_range = np.array(velocity_range)
             wavelength_range = \
-                velocity_range / c.c.to(u.km / u.s).value * ref_wl + ref_wl
+                velocity_range / _LS_KMS * ref_wl + ref_wl
         else:
             raise ValueError('Either wavelength range or velocity range and '
                              'ref_wl have to be provided.')
 
-        if self.instrument == 'cos':
-            ind = tools.pick_side(self.wavelength, wavelength_range)
+        ind, min_wl, max_wl = self._slice(wavelength_range)
+        if ind is not None:
             wavelength = self.wavelength[ind]
             flux = self.flux[ind]
             f_unc = self.error[ind]
@@ -476,11 +692,8 @@ class UVSpectrum(object):
             flux = self.flux
             f_unc = self.error
 
-        min_wl = tools.nearest_index(wavelength, wavelength_range[0])
-        max_wl = tools.nearest_index(wavelength, wavelength_range[1])
         if ref_wl is not None:
-            velocity = (wavelength[min_wl:max_wl] - ref_wl) / ref_wl * \
-                       c.c.to(u.km / u.s).value
+            velocity = (wavelength[min_wl:max_wl] - ref_wl) / ref_wl * _LS_KMS
             return wavelength[min_wl:max_wl], velocity, flux[min_wl:max_wl], \
                 f_unc[min_wl:max_wl]
         else:
@@ -491,7 +704,7 @@ class UVSpectrum(object):
     def plot_spectrum(self, wavelength_range=None, velocity_range=None,
                       chip_index=None, plot_uncertainties=False,
                       rotate_x_ticks=30, ref_wl=None, flag=None, scale=None,
-                      rv_shift=0.0, **kwargs):
+                      rv_shift=0.0, downsample=True, **kwargs):
         """
         Plot the spectrum, with the option of selecting a specific wavelength
         range or the red or blue chips of the detector. In order to visualize
@@ -517,6 +730,10 @@ class UVSpectrum(object):
 
             ref_wl (``float``, optional): Reference wavelength used to plot the
                 spectra in Doppler velocity space.
+
+            downsample (``bool``, optional): If set to ``True``, long spectra
+                are plotted with a stride that keeps about 2000 points. Set it
+                to ``False`` to plot every pixel. Default is ``True``.
         """
         ax = plt.subplot()
 
@@ -535,48 +752,50 @@ class UVSpectrum(object):
         if wavelength_range is None and velocity_range is not None:
             velocity_range = np.array(velocity_range)
             wavelength_range = \
-                velocity_range / c.c.to(u.km / u.s).value * ref_wl + ref_wl
+                velocity_range / _LS_KMS * ref_wl + ref_wl
         else:
             pass
 
         if wavelength_range is not None:
-            if self.instrument == 'cos':
-                ind = tools.pick_side(self.wavelength, wavelength_range)
-                wavelength = self.wavelength[ind]
-                flux = self.flux[ind] / scale
-                f_unc = self.error[ind] / scale
-                quality = self.quality[ind]
+            ind, min_wl, max_wl = self._slice(wavelength_range)
+            if ind is not None:
+                wavelength = self.wavelength[ind][min_wl:max_wl]
+                flux = self.flux[ind][min_wl:max_wl] / scale
+                f_unc = self.error[ind][min_wl:max_wl] / scale
             else:
-                wavelength = self.wavelength
-                flux = self.flux / scale
-                f_unc = self.error / scale
-                quality = self.quality
-
-            min_wl = tools.nearest_index(wavelength, wavelength_range[0])
-            max_wl = tools.nearest_index(wavelength, wavelength_range[1])
+                wavelength = self.wavelength[min_wl:max_wl]
+                flux = self.flux[min_wl:max_wl] / scale
+                f_unc = self.error[min_wl:max_wl] / scale
 
             if isinstance(ref_wl, float):
-                x_axis = c.c.to(u.km / u.s).value * \
-                    (wavelength[min_wl:max_wl] - ref_wl) / ref_wl
+                x_axis = wavelength - ref_wl
+                x_axis *= _LS_KMS / ref_wl
                 x_axis += rv_shift
                 x_label = r'Velocity (km s$^{-1}$)'
             else:
-                x_axis = wavelength[min_wl:max_wl]
-                wl_shift = rv_shift / c.c.to(u.km / u.s).value * x_axis
-                x_axis += wl_shift
+                x_axis = wavelength * (1 + rv_shift / _LS_KMS)
                 x_label = r'Wavelength ($\mathrm{\AA}$)'
 
+            # Screens are not wide enough to show more than ~2000 points
+            if downsample is True:
+                stride = max(1, (max_wl - min_wl) // 2000)
+            else:
+                stride = 1
+
             # Finally plot it
             if plot_uncertainties is False:
-                ax.plot(x_axis, flux[min_wl:max_wl], **kwargs)
+                ax.plot(x_axis[::stride], flux[::stride], **kwargs)
             else:
-                ax.errorbar(x_axis, flux[min_wl:max_wl],
-                             yerr=f_unc[min_wl:max_wl],
-                             fmt='.', **kwargs)
+                ax.errorbar(x_axis[::stride], flux[::stride],
+                             yerr=f_unc[::stride], fmt='.', **kwargs)
 
             # Overplot a span where there is a specific flag
             if flag is not None:
-                dq_inds = np.where(quality[min_wl:max_wl] == flag)[0]
+                if ind is not None:
+                    quality = self.quality[ind][min_wl:max_wl]
+                else:
+                    quality = self.quality[min_wl:max_wl]
+                dq_inds = np.where(quality == flag)[0]
                 for i in dq_inds:
                     ax.axvline(x=x_axis[i], color='k', alpha=0.1)
 
@@ -588,13 +807,17 @@ class UVSpectrum(object):
                 chip_index = 0
             elif chip_index == 'blue':
                 chip_index = 1
+            if downsample is True:
+                stride = max(1, len(self.wavelength[chip_index]) // 2000)
+            else:
+                stride = 1
             if plot_uncertainties is False:
-                ax.plot(self.wavelength[chip_index],
-                         self.flux[chip_index], **kwargs)
+                ax.plot(self.wavelength[chip_index][::stride],
+                         self.flux[chip_index][::stride], **kwargs)
             else:
-                ax.errorbar(self.wavelength[chip_index],
-                             self.flux[chip_index],
-                             yerr=self.error[chip_index],
+                ax.errorbar(self.wavelength[chip_index][::stride],
+                             self.flux[chip_index][::stride],
+                             yerr=self.error[chip_index][::stride],
                              fmt='.', **kwargs)
             ax.set_xlabel(r'Wavelength ($\mathrm{\AA}$)')
             ax.set_ylabel(y_label)
@@ -631,10 +854,10 @@ class UVSpectrum(object):
 
         """
         # Find the Doppler velocities from line center
-        light_speed = c.c.to(u.km / u.s).value
+        light_speed = _LS_KMS
         if isinstance(line, spectroscopy.Line):
-            if self.instrument == 'cos':
-                ind = tools.pick_side(self.wavelength, line.wavelength_range)
+            ind, min_wl, max_wl = self._slice(line.wavelength_range)
+            if ind is not None:
                 wavelength = self.wavelength[ind]
                 flux = self.flux[ind]
                 f_unc = self.error[ind]
@@ -643,11 +866,8 @@ class UVSpectrum(object):
                 flux = self.flux
                 f_unc = self.error
 
-            min_wl = tools.nearest_index(wavelength, line.wavelength_range[0])
-            max_wl = tools.nearest_index(wavelength, line.wavelength_range[1])
-            doppler_v = \
-                (wavelength[min_wl:max_wl] - line.central_wavelength)\
-                / line.central_wavelength * light_speed
+            doppler_v = wavelength[min_wl:max_wl] - line.central_wavelength
+            doppler_v *= light_speed / line.central_wavelength
             flux = flux[min_wl:max_wl]
             unc = f_unc[min_wl:max_wl]
 
@@ -673,13 +893,41 @@ class UVSpectrum(object):
         Returns:
 
         """
-        ind = tools.pick_side(self.wavelength, wavelength_range)
-        min_wl = tools.nearest_index(self.wavelength[ind], wavelength_range[0])
-        max_wl = tools.nearest_index(self.wavelength[ind], wavelength_range[1])
-        wl_array = self.wavelength[ind][min_wl:max_wl + 1]
+        ind, min_wl, max_wl = self._slice(wavelength_range)
+        if ind is not None:
+            wl_array = self.wavelength[ind][min_wl:max_wl + 1]
+        else:
+            wl_array = self.wavelength[min_wl:max_wl + 1]
         return wl_array
 
 
+# Column of the x1d data of a COS spectrum, extracted on first access
+class _ChipColumn(object):
+    """
+    Descriptor for the attributes of ``COSSpectrum`` that contain a column of
+    the x1d data sliced for each chip. The column is only extracted from the
+    (memory-mapped) data the first time the attribute is accessed; after that,
+    it is stored in the instance like a regular attribute.
+
+    Args:
+
+        column (``str``): Name of the column in the x1d data.
+    """
+    def __init__(self, column):
+        self.column = column
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = instance._chips(self.column)
+        instance.__dict__[self.name] = value
+        return value
+
+
 # COS spectrum class
 class COSSpectrum(UVSpectrum):
     """
@@ -698,6 +946,17 @@ class COSSpectrum(UVSpectrum):
             chip. If ``None``, use all pixels. Default is
             ``((1260, 15170), (1025, 15020))``.
     """
+    # The spectral data are only read from the x1d file when needed
+    wavelength = _ChipColumn('WAVELENGTH')
+    flux = _ChipColumn('FLUX')
+    error = _ChipColumn('ERROR')
+    quality = _ChipColumn('DQ')
+    gross_counts = _ChipColumn('GCOUNTS')
+    background = _ChipColumn('BACKGROUND')
+    net = _ChipColumn('NET')
+    _x1d_columns = ['WAVELENGTH', 'FLUX', 'ERROR', 'DQ', 'GCOUNTS',
+                    'BACKGROUND', 'NET', 'EXPTIME']
+
     def __init__(self, dataset_name,
                  good_pixel_limits=((1260, 15170), (1025, 15020)), prefix=None,
                  subexposure=False):
@@ -719,25 +978,11 @@ class COSSpectrum(UVSpectrum):
             self.end_JD = Time(f[3].header['EXPENDJ'], format='jd')
 
         # Extract the most important information from the data
-        i00 = self.gpl[0][0]
-        i01 = self.gpl[0][1]
-        i10 = self.gpl[1][0]
-        i11 = self.gpl[1][1]
-        self.wavelength = np.array([self.data['WAVELENGTH'][0][i00:i01],
-                                    self.data['WAVELENGTH'][1][i10:i11]])
-        self.flux = np.array([self.data['FLUX'][0][i00:i01],
-                              self.data['FLUX'][1][i10:i11]])
-        self.error = np.array([self.data['ERROR'][0][i00:i01],
-                               self.data['ERROR'][1][i10:i11]])
-        self.gross_counts = np.array([self.data['GCOUNTS'][0][i00:i01],
-                                      self.data['GCOUNTS'][1][i10:i11]])
-        self.background = np.array([self.data['BACKGROUND'][0][i00:i01],
-                                    self.data['BACKGROUND'][1][i10:i11]])
-        self.net = np.array([self.data['NET'][0][i00:i01],
-                             self.data['NET'][1][i10:i11]])
+        self._delta_wl = [np.diff(chip) for chip in self.wavelength]
+        # The wavelengths increase monotonically, so the first and last values
+        # are the limits of each chip
+        self._chip_limits = [(chip[0], chip[-1]) for chip in self.wavelength]
         self.exp_time = self.data['EXPTIME'][0]
-        self.quality = np.array([self.data['DQ'][0][i00:i01],
-                                 self.data['DQ'][1][i10:i11]])
         self.visit_id = self.header['ASN_TAB'][:9]
 
         # Appending some important jitter information
@@ -779,18 +1024,66 @@ class COSSpectrum(UVSpectrum):
 
         # Instantiating useful global variables
         self.sensitivity = None
+        self._sensitivity_shift_net = None  # shift_net of the sensitivity
         self.split = None
         self._systematics = None
         self.ccf = None
 
+    # Extract a column of the x1d data for each chip of the detector
+    def _chips(self, column):
+        """
+        Slice a column of the x1d data using the good pixel limits of each chip.
+        The slices are views of the (memory-mapped) data, so no copies are made.
+
+        Args:
+            column (``str``): Name of the column in the x1d data.
+
+        Returns:
+            chips (``list``): List containing the arrays of the red and blue
+                chips, in this order.
+        """
+        data = self.data[column]
+        return [data[0][self.gpl[0][0]:self.gpl[0][1]],
+                data[1][self.gpl[1][0]:self.gpl[1][1]]]
+
     # Compute the correct errors for the HST/COS observation
-    def compute_proper_error(self, shift_net=1E-7):
+    def compute_proper_error(self, shift_net=1E-7, update_sensitivity=True):
         """
         Compute the proper uncertainties of the HST/COS spectrum, following the
         method proposed by Wilson+ 2017 (ADS code = 2017A&A...599A..75W).
+
+        Args:
+
+            shift_net (``float``, optional): Small value added to the net
+                counts to avoid divisions by zero. Default is ``1E-7``.
+
+            update_sensitivity (``bool``, optional): If ``False``, the
+                sensitivity computed in a previous call with the same
+                ``shift_net`` is reused, and only the count-dependent term of
+                the uncertainties is recomputed. Only use it if the fluxes and
+                net counts have not changed since then. Default is ``True``.
         """
-        self.sensitivity = self.flux / (self.net + shift_net) / self.exp_time
-        self.error = (self.gross_counts + 1.0) ** 0.5 * self.sensitivity
+        if update_sensitivity is True or self.sensitivity is None or \
+                self._sensitivity_shift_net != shift_net:
+            self.sensitivity = []
+            # The operations are done in place, so that only the output arrays
+            # are allocated for each chip. These are double precision even
+            # though the x1d data are single precision
+            for k in range(2):
+                sensitivity = np.add(self.net[k], shift_net, dtype=float)
+                sensitivity *= self.exp_time
+                np.divide(self.flux[k], sensitivity, out=sensitivity)
+                self.sensitivity.append(sensitivity)
+            self._sensitivity_shift_net = shift_net
+        else:
+            pass
+
+        self.error = []
+        for k in range(2):
+            error = np.add(self.gross_counts[k], 1.0, dtype=float)
+            np.sqrt(error, out=error)
+            error *= self.sensitivity[k]
+            self.error.append(error)
 
     # Time tag split the observation
     def time_tag_split(self, n_splits=None, time_bins=None, out_dir="",
@@ -811,6 +1104,11 @@ class COSSpectrum(UVSpectrum):
         Returns:
 
         """
+        # The HST calibration packages are slow to import, so they are only
+        # imported when needed
+        from costools import splittag, x1dcorr
+        from calcos.x1d import concatenateSegments
+
         # First check if out_dir exists; if not, create it
         if os.path.isdir(out_dir) is False:
             os.mkdir(out_dir)
@@ -825,12 +1123,7 @@ class COSSpectrum(UVSpectrum):
             pass
 
         if time_bins is not None:
-            time_list = ""
-            for time in time_bins:
-                time_list += str(time) + ', '
-
-            # Remove the last comma and space from the string
-            time_list = time_list[:-2]
+            time_list = ', '.join(str(time) for time in time_bins)
 
             # Add a forward slash to out_dir if it is not there
             if out_dir[-1] != '/':
@@ -859,69 +1152,51 @@ class COSSpectrum(UVSpectrum):
             # Some hack necessary to avoid IO error when using x1dcorr
             split_list = glob.glob(out_dir + self.dataset_name +
                                    '_?_corrtag_?.fits')
+            corrtag_list = []
             for item in split_list:
-                char_list = list(item)
-                char_list.insert(-13, char_list.pop(-6))
-                char_list.insert(-12, char_list.pop(-6))
-                link = ""
-                new_item = link.join(char_list)
+                new_item = _SEGMENT_LAST.sub(r'_\1_\2_corrtag.fits', item)
                 os.rename(item, new_item)
+                corrtag_list.append(new_item)
 
             # Set lref environment variable
             if not 'lref' in os.environ:
                 os.environ['lref'] = path_calibration_files
 
             # Extract the tag-split spectra
-            split_list = glob.glob(out_dir + self.dataset_name +
-                                   '_?_?_corrtag.fits')
-            for item in split_list:
+            for item in corrtag_list:
                 x1dcorr.x1dcorr(input=item, outdir=out_dir)
 
-            # Clean the intermediate steps files
-            if clean_intermediate_steps is True:
-
-                remove_list = glob.glob(out_dir + self.dataset_name +
-                                        '*_flt.fits')
-                for item in remove_list:
-                    os.remove(item)
-
-                remove_list = glob.glob(out_dir + self.dataset_name +
-                                        '*_counts.fits')
-                for item in remove_list:
-                    os.remove(item)
-
-            # Return the filenames back to normal
-            split_list = glob.glob(out_dir + self.dataset_name +
-                                   '*_corrtag.fits')
-            for item in split_list:
-                char_list = list(item)
-                char_list.insert(-5, char_list.pop(-15))
-                char_list.insert(-5, char_list.pop(-15))
-                link = ""
-                new_item = link.join(char_list)
-                os.rename(item, new_item)
-            split_list = glob.glob(out_dir + self.dataset_name + '*_x1d.fits')
-            for item in split_list:
-                char_list = list(item)
-                char_list.insert(-5, char_list.pop(-9))
-                char_list.insert(-5, char_list.pop(-10))
-                link = ""
-                new_item = link.join(char_list)
-                os.rename(item, new_item)
+            # Clean the intermediate steps files and return the filenames back
+            # to normal, using a single listing of the output directory
+            with os.scandir(out_dir) as entries:
+                file_list = [entry.name for entry in entries
+                             if entry.name.startswith(self.dataset_name)]
+            segment_x1d = {}
+            for name in file_list:
+                match = _SEGMENT_FIRST.search(name)
+                if name.endswith('_flt.fits') or name.endswith('_counts.fits'):
+                    if clean_intermediate_steps is True:
+                        os.remove(out_dir + name)
+                elif match is not None:
+                    new_item = out_dir + \
+                        _SEGMENT_FIRST.sub(r'_\1_\3_\2.fits', name)
+                    os.rename(out_dir + name, new_item)
+                    if match.group(3) == 'x1d':
+                        segment_x1d.setdefault(int(match.group(1)),
+                                               []).append(new_item)
+                else:
+                    pass
 
             # Concatenate segments `a` and `b` of the detector
             for i in range(n_splits):
-                x1d_list = glob.glob(out_dir + self.dataset_name +
-                                     '_%i_x1d_?.fits' % (i + 1))
+                x1d_list = sorted(segment_x1d.get(i + 1, []))
                 concatenateSegments(x1d_list, out_dir + self.dataset_name +
                                     '_%i' % (i + 1) + '_x1d.fits')
 
-            # Remove more intermediate steps
-            if clean_intermediate_steps is True:
-                remove_list = glob.glob(out_dir + self.dataset_name +
-                                        '_?_x1d_?.fits')
-                for item in remove_list:
-                    os.remove(item)
+                # Remove more intermediate steps
+                if clean_intermediate_steps is True:
+                    for item in x1d_list:
+                        os.remove(item)
 
             # Finally add each tag-split observation to the `self.split` object
             self.split = []
@@ -950,15 +1225,16 @@ class COSSpectrum(UVSpectrum):
             pass
 
         # Find the number of splits
-        split_list = glob.glob(path + self.dataset_name + '_?_x1d.fits')
+        split_list = sorted(glob.glob(path + self.dataset_name +
+                                      '_?_x1d.fits'))
         n_splits = len(split_list)
 
         # Add each tag-split observation to the `self.split` object
         self.split = []
         time_step = ((self.exp_time / n_splits) * u.s).to(u.d)
         for i in range(n_splits):
-            offset = len(path)
-            dataset_name = split_list[i][offset:offset + 11]
+            dataset_name = \
+                os.path.basename(split_list[i]).replace('_x1d.fits', '')
             split_obs = COSSpectrum(dataset_name, prefix=path, subexposure=True)
             split_obs.start_JD += i * time_step
             split_obs.end_JD -= time_step * (n_splits - i - 1)
@@ -1005,10 +1281,14 @@ class COSSpectrum(UVSpectrum):
         else:
             pass
 
-        flux = []
-        f_unc = []
+        # The integrated fluxes of each line (rows) in each split (columns)
+        n_splits = len(self.split)
+        n_lines_total = sum(len(line_list[species]) for species in line_list)
+        flux = np.empty((n_lines_total, n_splits))
+        f_unc = np.empty_like(flux)
 
         # For each species in the line list
+        row = 0
         for species in line_list:
             n_lines = len(line_list[species])
             # For each spectral line of a species
@@ -1019,42 +1299,32 @@ class COSSpectrum(UVSpectrum):
                     rv_shift = 0.0
                 if rv_range is not None:
                     ref_wl = line_list[species][i].central_wavelength
-                    for split in self.split:
-                        f, unc = split.integrated_flux(reference_wl=ref_wl,
-                                                       rv_range=rv_range,
-                                                       rv_correction=rv_shift)
-                        flux.append(f)
-                        f_unc.append(unc)
+                    for j, split in enumerate(self.split):
+                        flux[row, j], f_unc[row, j] = split.integrated_flux(
+                            reference_wl=ref_wl, rv_range=rv_range,
+                            rv_correction=rv_shift)
                 else:
                     wl_range = line_list[species][i].wavelength_range
                     # For each split in the observation
-                    for split in self.split:
-                        f, unc = split.integrated_flux(
+                    for j, split in enumerate(self.split):
+                        flux[row, j], f_unc[row, j] = split.integrated_flux(
                             wavelength_range=wl_range)
-                        flux.append(f)
-                        f_unc.append(unc)
+                row += 1
 
         # Compute times of the observation (this is a repetition of code, should
         # be automated at some point.
-        n_splits = len(self.split)
-        time = []
-        t_span = []
-        for i in range(n_splits):
-            time.append((self.split[i].start_JD.jd +
-                         self.split[i].end_JD.jd) / 2)
-            t_span.append((self.split[i].start_JD.jd -
-                           self.split[i].end_JD.jd) / 2)
-        time = np.array(time)
-        t_span = np.array(t_span)
+        start = np.fromiter((split.start_JD.jd for split in self.split),
+                            dtype=np.float64, count=n_splits)
+        end = np.fromiter((split.end_JD.jd for split in self.split),
+                          dtype=np.float64, count=n_splits)
+        time = (start + end) / 2
+        t_span = (start - end) / 2
         self._systematics['time'] = time
 
         # Compute sum of integrated fluxes
-        n_lines = len(flux) // n_splits
-        flux = np.reshape(np.array(flux), (n_lines, n_splits))
-        f_unc = np.reshape(np.array(f_unc), (n_lines, n_splits))
         total_flux = flux.sum(axis=0)
         self._systematics['flux'] = total_flux
-        total_unc = ((f_unc ** 2).sum(axis=0)) ** 0.5
+        total_unc = np.sqrt(np.einsum('ij,ij->j', f_unc, f_unc))
         self._systematics['f_unc'] = total_unc
 
         # Plot the computed fluxes
@@ -1118,30 +1388,30 @@ class COSSpectrum(UVSpectrum):
         norm = baseline_level
         n_splits = len(self.split)
         mod_jd = time - temp_jd_shift
-        coeff = np.polyfit(mod_jd, total_flux / norm, deg=poly_deg)
-        func = np.poly1d(coeff)
+        func = Polynomial.fit(mod_jd, total_flux / norm, deg=poly_deg)
         corr_factor = func(mod_jd)  # Array of correction factors
+        inv_corr = 1.0 / corr_factor
 
         # Now we change the spectral flux in each split of this ``COSSpectrum``
-        # to take into account the systematics
+        # to take into account the systematics. The fluxes of each chip are
+        # stacked in an array with shape (n_splits, n_pixels), so all splits
+        # are corrected at once, and the fluxes of each split become views of
+        # the stacked arrays
+        split_flux = [np.stack([split.flux[k] for split in self.split])
+                      for k in range(2)]
+        for k in range(2):
+            split_flux[k] *= inv_corr[:, None]
         for i in range(n_splits):
-            self.split[i].flux[0] /= corr_factor[i]
-            self.split[i].flux[1] /= corr_factor[i]
+            self.split[i].flux = [split_flux[k][i] for k in range(2)]
             if recompute_errors is True:
                 self.split[i].compute_proper_error()
 
         # Now correct the spectral flux of the ``COSSpectrum`` itself. The flux
         # will be given by the mean of the flux of all splits and the
         # uncertainties by the quadratic sum of those of the splits
-        for k in range(2):
-            sum_split_flux = []
-            for split in self.split:
-                sum_split_flux.append(split.flux[k])
-            sum_split_flux = np.array(sum_split_flux)
-            mean_flux = sum_split_flux.sum(axis=0) / n_splits
-            self.flux[k] = mean_flux
-            if recompute_errors is True:
-                self.compute_proper_error()
+        self.flux = [split_flux[k].mean(axis=0) for k in range(2)]
+        if recompute_errors is True:
+            self.compute_proper_error()
 
 
 # STIS spectrum class
@@ -1156,6 +1426,9 @@ class STISSpectrum(UVSpectrum):
             For example, if the 1-d extracted spectrum file is named
             ``'foo_x1d.fits'``, then the dataset name is ``'foo'``.
     """
+    _x1d_columns = ['WAVELENGTH', 'FLUX', 'ERROR', 'GROSS', 'BACKGROUND',
+                    'NET']
+
     def __init__(self, dataset_name, prefix=None, subexposure=False):
         super(STISSpectrum, self).__init__(dataset_name, prefix=prefix)
         self.instrument = 'stis'
@@ -1172,6 +1445,7 @@ class STISSpectrum(UVSpectrum):
         self.end_JD = Time(self.header['EXPEND'] + bjd_shift,
                            format='jd')
         self.wavelength = self.data['WAVELENGTH'][0]
+        self._delta_wl = np.diff(self.wavelength)
         self.flux = self.data['FLUX'][0]
         self.error = self.data['ERROR'][0]
         self.exp_time = self.header['EXPTIME']
@@ -1251,27 +1525,24 @@ class STISSpectrum(UVSpectrum):
         Returns:
 
         """
+        # The HST calibration packages are slow to import, so they are only
+        # imported when needed
+        from stistools import inttag
+
         # First check if out_dir exists; if not, create it
         if os.path.isdir(out_dir) is False:
             os.mkdir(out_dir)
         else:
             pass
 
-        # Create the time_list string from time_bins if the user specified them,
-        # or from the number of splits the user requested
+        # Create the time bins from the number of splits the user requested, if
+        # they were not specified
         if isinstance(n_splits, int):
             time_bins = np.linspace(0, self.exp_time, n_splits + 1)
         else:
             pass
 
         if time_bins is not None:
-            time_list = ""
-            for time in time_bins:
-                time_list += str(time) + ', '
-
-            # Remove the last comma and space from the string
-            time_list = time_list[:-2]
-
             # Add a forward slash to out_dir if it is not there
             if out_dir[-1] != '/':
                 out_dir += '/'
@@ -1308,15 +1579,16 @@ class STISSpectrum(UVSpectrum):
             pass
 
         # Find the number of splits
-        split_list = glob.glob(path + self.dataset_name + '_?_x1d.fits')
+        split_list = sorted(glob.glob(path + self.dataset_name +
+                                      '_?_x1d.fits'))
         n_splits = len(split_list)
 
         # Add each tag-split observation to the `self.split` object
         self.split = []
         time_step = ((self.exp_time / n_splits) * u.s).to(u.d)
         for i in range(n_splits):
-            offset = len(path)
-            dataset_name = split_list[i][offset:offset + 11]
+            dataset_name = \
+                os.path.basename(split_list[i]).replace('_x1d.fits', '')
             split_obs = STISSpectrum(dataset_name, prefix=path,
                                      subexposure=True)
             self.split.append(split_obs)
@@ -1352,7 +1624,7 @@ class CombinedSpectrum(object):
         if doppler_corr is None:
             doppler_corr = [0.0 for i in range(self._n_orbit)]
 
-        ls = c.c.to(u.km / u.s).value
+        ls = _LS_KMS
         # if self._ref_wl is not None:
         wl_shift = [self._ref_wl * dck / ls for dck in doppler_corr]
         # else:
@@ -1382,7 +1654,7 @@ class CombinedSpectrum(object):
             # (only for COS)
             self.total_exp_time += self._orbits[i].exp_time
             if instrument == 'cos':
-                ind = tools.pick_side(self._orbits[i].wavelength,
+                ind = tools.pick_side(self._orbits[i]._chip_limits,
                                       wavelength_range)
                 wavelength = self._orbits[i].wavelength[ind]
                 if cleaned_spectra is True:
@@ -1405,10 +1677,9 @@ class CombinedSpectrum(object):
 
             # Now find which spectrum indexes correspond to the requested
             # wavelength
-            min_wl = tools.nearest_index(wavelength + wl_shift[i],
-                                         wavelength_range[0])
-            max_wl = tools.nearest_index(wavelength + wl_shift[i],
-                                         wavelength_range[1])
+            min_wl, max_wl = tools.nearest_index(
+                wavelength + wl_shift[i],
+                np.array([wavelength_range[0], wavelength_range[1]]))
 
             # Finally add the spectrum to the list
             velocity = (wavelength[min_wl:max_wl] - self._ref_wl) / \
@@ -1428,53 +1699,55 @@ class CombinedSpectrum(object):
 
         self.velocity = velocity_grid
         for i in range(self._n_orbit):
-            fw = interp1d(velocity_list[i], wavelength_list[i], kind='linear',
-                          bounds_error=False, fill_value='extrapolate')
-            ff = interp1d(velocity_list[i], flux_list[i], kind='linear',
-                          bounds_error=False, fill_value=1E-18)
-            fu = interp1d(velocity_list[i], f_unc_list[i], kind='linear',
-                          bounds_error=False, fill_value=1E-18)
-            fg = interp1d(velocity_list[i], gross_list[i], kind='linear',
-                          bounds_error=False, fill_value=1E-18)
-            fn = interp1d(velocity_list[i], net_list[i], kind='linear',
-                          bounds_error=False, fill_value=1E-18)
+            # The wavelengths are a linear function of the velocities, so they
+            # can be computed exactly (including outside of the range of the
+            # orbit) instead of extrapolated
+            wavelength_list[i] = (velocity_grid - doppler_corr[i]) / ls * \
+                self._ref_wl + self._ref_wl + wl_shift[i]
+            flux_list[i] = np.interp(velocity_grid, velocity_list[i],
+                                     flux_list[i], left=1E-18, right=1E-18)
+            f_unc_list[i] = np.interp(velocity_grid, velocity_list[i],
+                                      f_unc_list[i], left=1E-18, right=1E-18)
+            gross_list[i] = np.interp(velocity_grid, velocity_list[i],
+                                      gross_list[i], left=1E-18, right=1E-18)
+            net_list[i] = np.interp(velocity_grid, velocity_list[i],
+                                    net_list[i], left=1E-18, right=1E-18)
             velocity_list[i] = velocity_grid
-            wavelength_list[i] = fw(velocity_grid)
-            flux_list[i] = ff(velocity_grid)
-            f_unc_list[i] = fu(velocity_grid)
-            gross_list[i] = fg(velocity_grid)
-            net_list[i] = fn(velocity_grid)
         self.wavelength = wavelength_list[0]
-        self.test = np.array(flux_list)
+
+        # Stack the spectra only once, since they all share the same grid now
+        flux_list = np.array(flux_list)
+        f_unc_list = np.array(f_unc_list)
+        gross_list = np.array(gross_list)
+        net_list = np.array(net_list)
+        self.test = flux_list
 
         # Calculating the final flux. There are two options: 1) Regular average,
         # or 2) Weighted average.
         if final_flux == 'average' or final_flux == 'mean':
-            self.flux = np.mean(np.array(flux_list), axis=0)
-            self.net = np.mean(np.array(net_list), axis=0)
+            self.flux = np.mean(flux_list, axis=0)
+            self.net = np.mean(net_list, axis=0)
         elif final_flux == 'weighted':
-            self.flux = np.sum(np.array(flux_list) * np.array(f_unc_list),
-                               axis=0) / np.sum(np.array(f_unc_list), axis=0)
-            self.net = np.sum(np.array(net_list) * np.array(f_unc_list),
-                               axis=0) / np.sum(np.array(f_unc_list), axis=0)
+            sum_f_unc = np.sum(f_unc_list, axis=0)
+            self.flux = np.einsum('ij,ij->j', flux_list, f_unc_list)
+            self.flux /= sum_f_unc
+            self.net = np.einsum('ij,ij->j', net_list, f_unc_list)
+            self.net /= sum_f_unc
 
         # Calculating the final gross counts and "sensitivity"
-        self.gross = np.sum(np.array(gross_list), axis=0)
+        self.gross = np.sum(gross_list, axis=0)
 
         # Calculating uncertainties. There are three options: 1) Simply combining
         # the tabulated uncertainties at face value, 2) Calculating the standard
         # deviation of the measured fluxes, or 3) Drawing samples and
         # calculating the percentiles of the sample.
         if final_uncertainty == 'combine':
-            self.f_unc = (np.sum(np.array(f_unc_list) ** 2, axis=0) /
-                          self._n_orbit) ** 0.5
+            self.f_unc = np.einsum('ij,ij->j', f_unc_list, f_unc_list)
+            self.f_unc /= self._n_orbit
+            np.sqrt(self.f_unc, out=self.f_unc)
         elif final_uncertainty == 'poisson':
-            combined_gross = np.zeros_like(self.wavelength)
-            sensitivity = np.nanmean(
-                np.array([flux_list[i] / net_list[i]
-                         for i in range(self._n_orbit)]), axis=0)
-            for i in range(self._n_orbit):
-                combined_gross += gross_list[i]
+            combined_gross = np.copy(self.gross)
+            sensitivity = np.nanmean(flux_list / net_list, axis=0)
             combined_gross_unc = []
             for k in range(len(self.wavelength)):
                 if combined_gross[k] < 0:
@@ -1484,7 +1757,7 @@ class CombinedSpectrum(object):
             combined_gross_unc = np.array(combined_gross_unc)
             self.f_unc = combined_gross_unc / self.total_exp_time * sensitivity
         elif final_uncertainty == 'stdev':
-            self.f_unc = np.std(np.array(flux_list), axis=0)
+            self.f_unc = np.std(flux_list, axis=0)
         elif final_uncertainty == 'sample':
             # For each wavelength bin and each exposure, we draw a random sample
             # of 500 measurements with mu = flux and sigma = uncertainty in a
@@ -1575,8 +1848,8 @@ class CombinedSpectrum(object):
         Returns:
 
         """
-        pylab.rcParams['figure.figsize'] = figure_sizes[0], figure_sizes[1]
-        pylab.rcParams['font.size'] = axes_font_size
+        plt.rcParams['figure.figsize'] = figure_sizes[0], figure_sizes[1]
+        plt.rcParams['font.size'] = axes_font_size
 
         line_center = self._ref_wl
 
@@ -1586,15 +1859,16 @@ class CombinedSpectrum(object):
         else:
             # Now find which spectrum indexes correspond to the requested
             # wavelength
-            min_wl = tools.nearest_index(self.wavelength, wavelength_range[0])
-            max_wl = tools.nearest_index(self.wavelength, wavelength_range[1])
+            min_wl, max_wl = tools.nearest_index(
+                self.wavelength,
+                np.array([wavelength_range[0], wavelength_range[1]]))
 
         # Figure out the x- and y-axes values
         if velocity_space is False:
             x_values = self.wavelength[min_wl:max_wl]
             x_label = r'Wavelength ($\mathrm{\AA}$)'
         else:
-            ls = c.c.to(u.km / u.s).value
+            ls = _LS_KMS
             x_values = (self.wavelength[min_wl:max_wl] - line_center) / \
                 line_center * ls
             x_label = r'Velocity (km s$^{-1}$)'
@@ -1649,23 +1923,21 @@ class CombinedSpectrum(object):
 
         """
 
-        min_wl = tools.nearest_index(self.wavelength, wavelength_range[0])
-        max_wl = tools.nearest_index(self.wavelength, wavelength_range[1])
-        # The following line is hacky, but it works
-        delta_wl = self.wavelength[1:] - self.wavelength[:-1]
-        int_flux = simps(self.flux[min_wl:max_wl],
-                         x=self.wavelength[min_wl:max_wl])
+        min_wl, max_wl = tools.nearest_index(
+            self.wavelength,
+            np.array([wavelength_range[0], wavelength_range[1]]))
+        # The wavelength bin widths are only needed inside the range
+        delta_wl = np.diff(self.wavelength[min_wl:max_wl + 1])
+        weights = tools.simpson_weights(self.wavelength[min_wl:max_wl])
+        int_flux = np.dot(weights, self.flux[min_wl:max_wl])
 
         # Calculating uncertainty
         if uncertainty_method == 'quadratic_sum':
-            uncertainty = np.sqrt(np.sum((delta_wl[min_wl:max_wl] *
-                                          self.f_unc[min_wl:max_wl]) ** 2))
+            d_unc = delta_wl * self.f_unc[min_wl:max_wl]
+            uncertainty = np.sqrt(np.dot(d_unc, d_unc))
         elif uncertainty_method == 'poisson':
-            delta_wl = np.concatenate(
-                (self.wavelength[1:] - self.wavelength[:-1],
-                 np.array([self.wavelength[-1] - self.wavelength[-2], ])))
             sensitivity = self.flux[min_wl:max_wl] / self.net[min_wl:max_wl]
-            mean_sensitivity = np.nanmean(sensitivity * delta_wl[min_wl:max_wl])
+            mean_sensitivity = np.nanmean(sensitivity * delta_wl)
             int_gross = np.sum(self.gross[min_wl:max_wl])
             gross_unc = poisson_conf_interval(int(int_gross),
                                               interval='root-n') - int_gross
@@ -1687,7 +1959,7 @@ class AirglowTemplate(object):
         self.wavelength = wavelength
         self.flux = flux
         self.f_unc = uncertainties
-        self._ls = c.c.to(u.km / u.s).value
+        self._ls = _LS_KMS
         if reference_wavelength is not None:
             self.ref_wl = reference_wavelength
         else:
@@ -1695,7 +1967,8 @@ class AirglowTemplate(object):
         self.velocity = (self.wavelength - self.ref_wl) * self._ls/ self.ref_wl
 
         # Other useful global variables
-        self._ls = c.c.to(u.km / u.s).value  # Light speed in km / s
+        self._ls = _LS_KMS  # Light speed in km / s
+        self._interp_cache = {}
 
     # Apply Doppler shift to the airglow spectrum
     def adjust_spectrum(self, doppler_shift=0.0 * u.km / u.s, scale_flux=1.0,
@@ -1740,8 +2013,29 @@ class AirglowTemplate(object):
         x = self.wavelength
         y1 = self.flux
         y2 = self.f_unc
-        f1 = interp1d(x, y1, kind=interpolation_type, fill_value='extrapolate')
-        f2 = interp1d(x, y2, kind=interpolation_type, fill_value='extrapolate')
+
+        # Linear interpolation does not need any interpolator objects
+        if interpolation_type == 'linear':
+            new_flux = tools.linear_interpolation(wavelength, x, y1)
+            new_f_unc = tools.linear_interpolation(wavelength, x, y2)
+            return new_flux, new_f_unc
+        else:
+            pass
+
+        # The interpolators are only built again if the template has changed
+        # since the last call
+        cached = self._interp_cache.get(interpolation_type)
+        if cached is None or cached[0] is not x or cached[1] is not y1 or \
+                cached[2] is not y2:
+            f1 = interp1d(x, y1, kind=interpolation_type,
+                          fill_value='extrapolate')
+            f2 = interp1d(x, y2, kind=interpolation_type,
+                          fill_value='extrapolate')
+            cached = (x, y1, y2, f1, f2)
+            self._interp_cache[interpolation_type] = cached
+        else:
+            pass
+        f1, f2 = cached[3], cached[4]
         new_flux = f1(wavelength)
         new_f_unc = f2(wavelength)
         return new_flux, new_f_unc
@@ -1763,21 +2057,23 @@ class AirglowTemplate(object):
         Returns:
 
         """
-        pylab.rcParams['figure.figsize'] = figure_sizes[0], figure_sizes[1]
-        pylab.rcParams['font.size'] = axes_font_size
+        plt.rcParams['figure.figsize'] = figure_sizes[0], figure_sizes[1]
+        plt.rcParams['font.size'] = axes_font_size
 
         # Plot either in wavelength- or velocity-space
         if wavelength_range is not None:
-            min_wl = tools.nearest_index(self.wavelength, wavelength_range[0])
-            max_wl = tools.nearest_index(self.wavelength, wavelength_range[1])
+            min_wl, max_wl = tools.nearest_index(
+                self.wavelength,
+                np.array([wavelength_range[0], wavelength_range[1]]))
             x_axis = self.wavelength[min_wl:max_wl]
             x_label = r'Wavelength ($\mathrm{\AA}$)'
         elif velocity_range is not None:
             vr = velocity_range
             wavelength_range = [vr[0] / self._ls * self.ref_wl + self.ref_wl,
                                 vr[1] / self._ls * self.ref_wl + self.ref_wl]
-            min_wl = tools.nearest_index(self.wavelength, wavelength_range[0])
-            max_wl = tools.nearest_index(self.wavelength, wavelength_range[1])
+            min_wl, max_wl = tools.nearest_index(
+                self.wavelength,
+                np.array([wavelength_range[0], wavelength_range[1]]))
             x_axis = (self.wavelength[min_wl:max_wl] - self.ref_wl) / \
                 self.ref_wl * self._ls
             x_label = r'Velocity (km s$^{-1}$)'
@@ -1823,7 +2119,7 @@ class SpectralLine(object):
             self.w0 = central_wavelength
 
         # Figure out the wavelength range
-        self.l_speed = c.c.to(u.km / u.s).value
+        self.l_speed = _LS_KMS
         try:
             self.ds_range = (doppler_shift_range[0].to(u.km / u.s).value,
                              doppler_shift_range[1].to(u.km / u.s).value)
@@ -1834,29 +2130,63 @@ class SpectralLine(object):
 
         # Extract the data from the spectrum, for each observation in the list
         # of COS spectra
-        ind = tools.pick_side(cos_observation[0].wavelength, self.wl_range)
-        min_wl = tools.nearest_index(cos_observation[0].wavelength[ind],
-                                     self.wl_range[0])
-        max_wl = tools.nearest_index(cos_observation[0].wavelength[ind],
-                                     self.wl_range[1])
-
-        self.wavelength = []
-        self.flux = []
-        self.f_unc = []
-        self.velocity = []
-        self.time = []
-        self.start_JD = []
-        self.end_JD = []
-        for ck in cos_observation:
-            self.wavelength.append(ck.wavelength[ind][min_wl:max_wl])
-            self.flux.append(ck.flux[ind][min_wl:max_wl])
-            self.f_unc.append(ck.error[ind][min_wl:max_wl])
-            self.velocity.append((self.wavelength[-1] - self.w0) *
-                                 self.l_speed / self.w0)
-            # Obtain other info that can be useful
-            self.start_JD.append(ck.start_JD.jd)
-            self.end_JD.append(ck.end_JD.jd)
-            self.time.append((self.start_JD[-1] + self.end_JD[-1]) / 2)
+        ind = tools.pick_side(cos_observation[0]._chip_limits, self.wl_range)
+        min_wl, max_wl = tools.nearest_index(
+            cos_observation[0].wavelength[ind],
+            np.array([self.wl_range[0], self.wl_range[1]]))
+
+        # All the spectra are sliced with the same indexes, so they are stored
+        # as 2-D arrays with one spectrum per row. They are double precision,
+        # so that Doppler shifted spectra written back to the rows are not
+        # truncated to the single precision of the x1d data
+        self.wavelength = np.array([ck.wavelength[ind][min_wl:max_wl]
+                                    for ck in cos_observation], dtype=float)
+        self.flux = np.array([ck.flux[ind][min_wl:max_wl]
+                              for ck in cos_observation], dtype=float)
+        self.f_unc = np.array([ck.error[ind][min_wl:max_wl]
+                               for ck in cos_observation], dtype=float)
+        self.velocity = (self.wavelength - self.w0) * self.l_speed / self.w0
+
+        # Obtain other info that can be useful
+        self.start_JD = np.fromiter((ck.start_JD.jd for ck in cos_observation),
+                                    dtype=float, count=self.n_spectra)
+        self.end_JD = np.fromiter((ck.end_JD.jd for ck in cos_observation),
+                                  dtype=float, count=self.n_spectra)
+        self.time = (self.start_JD + self.end_JD) / 2
+
+        # Wavelength bin widths and cache of the indexes found for each
+        # velocity range
+        self._delta_wl = np.diff(self.wavelength, axis=1)
+        self._bounds_cache = {}
+        # Spectra that share the same wavelength grid (e.g., time-tag splits
+        # of the same exposure) can be integrated all at once
+        self._same_grid = bool(np.all(self.wavelength == self.wavelength[0]))
+
+    # Find the indexes of a spectrum corresponding to a velocity range
+    def _bounds(self, i, velocity_range):
+        """
+        Find the indexes of the ``i``-th spectrum that correspond to the
+        limits of a velocity range. The results are cached, so repeated calls
+        with the same velocity range do not search the velocity array again.
+
+        Args:
+            i (``int``): Index of the spectrum.
+
+            velocity_range (array-like): Lower and upper bounds of the
+                velocity range.
+
+        Returns:
+            min_v (``int``): Index of the lower bound of the velocity range.
+
+            max_v (``int``): Index of the upper bound of the velocity range.
+        """
+        key = (i, velocity_range[0], velocity_range[1])
+        if key not in self._bounds_cache:
+            min_v, max_v = tools.nearest_index(
+                self.velocity[i], np.array([velocity_range[0],
+                                            velocity_range[1]]))
+            self._bounds_cache[key] = (min_v, max_v)
+        return self._bounds_cache[key]
 
     # Apply a Doppler shift to the spectra
     def doppler_shift(self, velocity, interpolation_type='linear',
@@ -1878,8 +2208,8 @@ class SpectralLine(object):
                                                       self.f_unc[i],
                                                       interpolation_type,
                                                       fill_value)
-            self.flux[i] = np.copy(new_flux)
-            self.f_unc[i] = np.copy(new_f_unc)
+            self.flux[i] = new_flux
+            self.f_unc[i] = new_f_unc
 
     # Plot the lines
     def plot(self, velocity_space=True, x_range=None, select_exposures=None,
@@ -1925,26 +2255,43 @@ class SpectralLine(object):
     # Integrate the flux of the lines between a range of velocities
     def integrated_flux(self, velocity_range=(-100, 100)):
         """
+        Compute the integrated flux of the line in each spectrum.
 
         Args:
-            velocity_range:
+
+            velocity_range (array-like, optional): Lower and upper bounds of
+                the Doppler velocity range of the integration, in km/s.
+                Default is ``(-100, 100)``.
 
         Returns:
 
-        """
-        int_flux = []
-        uncertainty = []
+            int_flux (``list``): Integrated flux of each spectrum.
 
-        for i in range(self.n_spectra):
-            min_v = tools.nearest_index(self.velocity[i], velocity_range[0])
-            max_v = tools.nearest_index(self.velocity[i], velocity_range[1])
-            delta_wl = self.wavelength[i][1:] - self.wavelength[i][:-1]
-            int_flux.append(simps(self.flux[i][min_v:max_v],
-                             self.wavelength[i][min_v:max_v]))
-            uncertainty.append(np.sqrt(np.sum((delta_wl[min_v:max_v] *
-                                          self.f_unc[i][min_v:max_v]) ** 2)))
+            uncertainty (``list``): Uncertainty of the integrated flux of each
+                spectrum.
+        """
+        # If all the spectra share the same wavelength grid, integrate them
+        # with a single matrix product
+        if self._same_grid:
+            min_v, max_v = self._bounds(0, velocity_range)
+            weights = tools.simpson_weights(self.wavelength[0][min_v:max_v])
+            flux = self.flux[:, min_v:max_v]
+            d_unc = self.f_unc[:, min_v:max_v] * self._delta_wl[0][min_v:max_v]
+            int_flux = flux.dot(weights)
+            uncertainty = np.sqrt(np.einsum('ij,ij->i', d_unc, d_unc))
+        else:
+            int_flux = np.empty(self.n_spectra)
+            uncertainty = np.empty(self.n_spectra)
+            for i in range(self.n_spectra):
+                min_v, max_v = self._bounds(i, velocity_range)
+                wavelength = self.wavelength[i][min_v:max_v]
+                weights = tools.simpson_weights(wavelength)
+                d_unc = self.f_unc[i][min_v:max_v] * \
+                    self._delta_wl[i][min_v:max_v]
+                int_flux[i] = np.dot(weights, self.flux[i][min_v:max_v])
+                uncertainty[i] = np.sqrt(np.dot(d_unc, d_unc))
 
-        return int_flux, uncertainty
+        return list(int_flux), list(uncertainty)
 
 
 # The Lyman-alpha profile class
@@ -1999,99 +2346,104 @@ class ContaminatedLine(SpectralLine):
         Returns:
 
         """
-        # Find the indexes of the velocity_range
-        min_v = []
-        max_v = []
+        # emcee is only needed here, so it is imported when needed
+        import emcee
+
+        # Find the indexes of the velocity_range in each spectrum, since their
+        # velocity grids are not necessarily the same
         if isinstance(velocity_range, list):
-            n_pass = 1
-            min_v.append(
-                tools.nearest_index(self.velocity[0], velocity_range[0]))
-            max_v.append(
-                tools.nearest_index(self.velocity[0], velocity_range[1]))
+            ranges = [velocity_range]
         elif isinstance(velocity_range, np.ndarray):
-            n_pass = np.shape(velocity_range)[0]
-            for i in range(n_pass):
-                min_v.append(
-                    tools.nearest_index(self.velocity[0], velocity_range[i, 0]))
-                max_v.append(
-                    tools.nearest_index(self.velocity[0], velocity_range[i, 1]))
+            ranges = list(velocity_range)
         else:
             raise TypeError('Wrong format for ``velocity_range``.')
-
-        # The badness of the fit function
+        n_pass = len(ranges)
+        v_bounds = [[self._bounds(i, rk) for rk in ranges]
+                    for i in range(self.n_spectra)]
+
+        # The Simpson's rule weights of each observation, which do not change
+        # during the fit
+        simpson_weights = [tools.simpson_weights(wk) for wk in self.wavelength]
+
+        # The template is fixed during the fit, so instead of Doppler shifting
+        # it at every step, the observed wavelengths are shifted back
+        ag_wavelength = self.ag_template.wavelength
+        ag_flux = self.ag_template.flux
+        ag_f_unc = self.ag_template.f_unc
+        shift_factor = self.ag_template.ref_wl / _LS_KMS
+
+        # The badness of the fit function. It is evaluated for a batch of
+        # parameter sets at once, one set per row of ``params``
         def _lnlike(params):
             if fixed_shift is True:
-                params[0] = shift_guess
+                params[:, 0] = shift_guess
             else:
                 pass
-            badness = []
+            badness = np.zeros(len(params))
+            shift = params[:, 0, None] * shift_factor
             # For each observation...
             for i in range(self.n_spectra):
 
-                # Compute the fluxes based on shift and scale
-                templ_flux, templ_error = \
-                    self.ag_template.adjust_spectrum(params[0],
-                                                     params[i + 1],
-                                                     fill_value=fill_value)
-
-                # Create temporary template
-                temporary_ag = AirglowTemplate(self.ag_template.wavelength,
-                                               templ_flux, templ_error, self.w0)
-                # Interpolate to the wavelengths of the observation
-                interp_flux, interp_error = \
-                    temporary_ag.interpolate_to(self.wavelength[i])
+                # Compute the fluxes based on shift and scale at the
+                # wavelengths of the observation
+                query_wl = self.wavelength[i] - shift
+                interp_flux = np.interp(query_wl, ag_wavelength, ag_flux,
+                                        left=fill_value, right=fill_value)
+                templ_error = np.interp(query_wl, ag_wavelength, ag_f_unc,
+                                        left=fill_value, right=fill_value)
+                interp_flux *= params[:, i + 1, None]
+                templ_error *= params[:, i + 1, None]
+
                 # Compute the difference between template and observed spectrum
                 diff = (self.flux[i] - interp_flux) * 1E13
-                u_diff = (self.f_unc[i] ** 2 + templ_error ** 2) ** 0.5
+                u_diff = np.hypot(self.f_unc[i], templ_error)
                 weight = 1 / (1E13 * u_diff) ** 2
 
+                # Punish the airglow model if the resulting cleaned spectra has
+                # negative flux
+                f_clip = np.clip(diff, a_min=None, a_max=0)
+                int_f_clip = f_clip.dot(simpson_weights[i])
+                int_u_clean = u_diff.dot(simpson_weights[i]) * 1E13
+                punish = neg_flux_severity * int_f_clip / int_u_clean
+
                 temp_badness = 0
                 # Add the badness of the core fit
                 for k in range(n_pass):
-                    lnlike = -0.5 * (np.sum(diff[min_v[k]:max_v[k]] ** 2 *
-                                            weight[min_v[k]:max_v[k]] -
-                                            np.log(weight[min_v[k]:max_v[k]])))
+                    min_v, max_v = v_bounds[i][k]
+                    lnlike = -0.5 * (np.sum(diff[:, min_v:max_v] ** 2 *
+                                            weight[:, min_v:max_v] -
+                                            np.log(weight[:, min_v:max_v]),
+                                            axis=1))
                     temp_badness += lnlike
-                    # Also punish the airglow model if the resulting cleaned
-                    # spectra has negative flux
-                    f_clip = np.clip(diff, a_min=None, a_max=0)
-                    int_f_clip = simps(f_clip, self.wavelength[i])
-                    int_u_clean = simps(u_diff * 1E13, self.wavelength[i])
-                    punish = neg_flux_severity * int_f_clip / int_u_clean
-                    badness.append(temp_badness + punish)
+                    badness += temp_badness + punish
 
-            badness = np.array(badness)
-            return np.sum(badness)
+            return badness
 
         # Flat prior
         def _lnprior(params):
-            if shift_bounds[0] < params[0] < shift_bounds[1]:
-                badness = 0
-                for i in range(self.n_spectra):
-                    if scale_bounds[0] < params[i + 1] < scale_bounds[1]:
-                        pass
-                    else:
-                        badness = -np.inf
-                        break
-                return badness
-            else:
-                return -np.inf
+            inside = (shift_bounds[0] < params[:, 0]) & \
+                (params[:, 0] < shift_bounds[1]) & \
+                np.all((scale_bounds[0] < params[:, 1:]) &
+                       (params[:, 1:] < scale_bounds[1]), axis=1)
+            return np.where(inside, 0.0, -np.inf)
 
-        # Probability function
+        # Probability function, evaluated for all the walkers at once
         def _lnprob(params):
             lp = _lnprior(params)
-            if not np.isfinite(lp):
-                return -np.inf
-            return lp + _lnlike(params)
+            inside = np.isfinite(lp)
+            if fixed_shift is True:
+                params[inside, 0] = shift_guess
+            else:
+                pass
+            lp[inside] += _lnlike(params[inside])
+            return lp
 
         # Perform the minimization of the badness of fit function
         guess = np.array([shift_guess] + scales_guess)
-        bounds = [list(shift_bounds)]
-        # Need to add bounds for each of the scale parameters, but all of them
-        # are `None`
-        for i in range(self.n_spectra):
-            bounds.append(list(scale_bounds))
-        nll = lambda *args: -_lnlike(*args)
+        # Need to add bounds for each of the scale parameters, which are all
+        # the same
+        bounds = [list(shift_bounds)] + [list(scale_bounds)] * self.n_spectra
+        nll = lambda params: -_lnlike(params[None, :])[0]
         self.fit_result = minimize(nll, x0=guess, method='TNC', bounds=bounds,
                                    options={'maxiter': maxiter_minimize})
 
@@ -2101,7 +2453,8 @@ class ContaminatedLine(SpectralLine):
             ndim = 1 + self.n_spectra
             pos = [self.fit_result["x"] + 1e-4*np.random.randn(ndim)
                    for i in range(n_walkers)]
-            sampler = emcee.EnsembleSampler(n_walkers, ndim, _lnprob)
+            sampler = emcee.EnsembleSampler(n_walkers, ndim, _lnprob,
+                                            vectorize=True)
             sampler.run_mcmc(pos, n_steps, progress=True)
             self.mcmc_sample = sampler.chain[:, int(n_steps / 10):, :].\
                 reshape((-1, ndim))
@@ -2127,11 +2480,14 @@ class ContaminatedLine(SpectralLine):
                 self.ag_template.adjust_spectrum(params[0],
                                                  params[i + 1],
                                                  fill_value=fill_value)
-            bf_templ = AirglowTemplate(self.ag_template.wavelength, bf_flux,
-                                       bf_error, self.w0)
-            bf_flux, bf_error = bf_templ.interpolate_to(self.wavelength[i])
+            # Interpolate to the wavelengths of the observation
+            ag_wavelength = self.ag_template.wavelength
+            bf_flux = tools.linear_interpolation(self.wavelength[i],
+                                                 ag_wavelength, bf_flux)
+            bf_error = tools.linear_interpolation(self.wavelength[i],
+                                                  ag_wavelength, bf_error)
             clean_flux.append(self.flux[i] - bf_flux)
-            clean_f_unc.append((self.f_unc[i] ** 2 + bf_error ** 2) ** 0.5)
+            clean_f_unc.append(np.hypot(self.f_unc[i], bf_error))
 
         return np.array(clean_flux), np.array(clean_f_unc)
 
@@ -2272,28 +2628,25 @@ class ContaminatedLine(SpectralLine):
         Returns:
 
         """
-        min_v = tools.nearest_index(self.velocity[0], velocity_range[0])
-        max_v = tools.nearest_index(self.velocity[0], velocity_range[1])
-
         int_flux = []
         uncertainty = []
 
         for i in range(self.n_spectra):
-            delta_wl = self.wavelength[i][1:] - self.wavelength[i][:-1]
-            int_flux.append(simps(self.clean_flux[i][min_v:max_v],
-                                  self.wavelength[i][min_v:max_v]))
+            min_v, max_v = self._bounds(i, velocity_range)
+            delta_wl = self._delta_wl[i]
+            weights = tools.simpson_weights(self.wavelength[i][min_v:max_v])
+            int_flux.append(np.dot(weights, self.clean_flux[i][min_v:max_v]))
             uncertainty.append(
                 np.sqrt(np.sum((delta_wl[min_v:max_v] *
                                 self.clean_f_unc[i][min_v:max_v]) ** 2)))
 
             # If clean spectra from the MCMC were calculated, then incorporate
-            # them in the uncertainties
+            # them in the uncertainties; all the samples are integrated with
+            # a single matrix product
             if self.clean_flux_sample is not None:
-                n_sample = len(self.clean_flux_sample)
-                int_flux_sample = np.array([simps(
-                    self.clean_flux_sample[k, i, min_v:max_v],
-                    self.wavelength[i][min_v:max_v]) for k in range(n_sample)])
+                int_flux_sample = \
+                    self.clean_flux_sample[:, i, min_v:max_v].dot(weights)
                 add_unc = np.std(int_flux_sample)
-                uncertainty[-1] = (uncertainty[-1] ** 2 + add_unc ** 2) ** 0.5
+                uncertainty[-1] = np.hypot(uncertainty[-1], add_unc)
 
         return np.array(int_flux), np.array(uncertainty)
@@ -1,4 +1,10 @@
+import os
+import tempfile
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
 import numpy as np
+from astropy.io import fits
 from . import hst_observation, spectroscopy
 
 datasets = ['ld9m10ujq', 'ld9m10uyq']
@@ -16,3 +22,62 @@ shift = np.array([-23.623059845212502, -23.37932521889708])
 orbit_list = [visit1.orbit['ld9m10ujq'], visit1.orbit['ld9m10uyq']]
 test = hst_observation.CombinedSpectrum(
     orbit_list, ref_wl, 'cos', velocity_range=[-100, 100], doppler_corr=shift)
+
+
+# Write a minimal STIS x1d file with a flat spectrum
+def _write_stis_x1d(path, dataset_name, n_pixels=1000):
+    wavelength = np.linspace(1190.0, 1250.0, n_pixels)
+    columns = [fits.Column(name=name, format='%iD' % n_pixels,
+                           array=np.array([values]))
+               for name, values in (('WAVELENGTH', wavelength),
+                                    ('FLUX', np.full(n_pixels, 1E-14)),
+                                    ('ERROR', np.full(n_pixels, 1E-15)),
+                                    ('GROSS', np.full(n_pixels, 10.0)),
+                                    ('BACKGROUND', np.full(n_pixels, 1.0)),
+                                    ('NET', np.full(n_pixels, 9.0)))]
+    primary = fits.PrimaryHDU()
+    primary.header['OPT_ELEM'] = 'G140M'
+    primary.header['APERTURE'] = '52X0.1'
+    table = fits.BinTableHDU.from_columns(columns, name='SCI')
+    table.header['EXPSTART'] = 58000.0
+    table.header['EXPEND'] = 58000.01
+    table.header['EXPTIME'] = 864.0
+    fits.HDUList([primary, table]).writeto(
+        os.path.join(path, dataset_name + '_x1d.fits'))
+
+
+# STIS spectra have no data quality array, so plotting a range must not use it
+def test_stis_plot_spectrum_range():
+    with tempfile.TemporaryDirectory() as path:
+        _write_stis_x1d(path, 'test')
+        spectrum = hst_observation.STISSpectrum('test', prefix=path + '/',
+                                                subexposure=True)
+        ax = spectrum.plot_spectrum(wavelength_range=(1200.0, 1230.0))
+        assert len(ax.lines) == 1
+        plt.close('all')
+        ax = spectrum.plot_spectrum(velocity_range=(-500.0, 500.0),
+                                    ref_wl=1215.67)
+        x_axis = ax.lines[0].get_xdata()
+        assert x_axis.min() > -510.0 and x_axis.max() < 510.0
+        plt.close('all')
+
+
+# The uncertainties follow in-place edits of the flux, unless the sensitivity
+# is explicitly reused
+def test_compute_proper_error_after_flux_edit():
+    orbit = hst_observation.COSSpectrum('ld9m10ujq', prefix='data/')
+    orbit.compute_proper_error()
+    error = [ek.copy() for ek in orbit.error]
+    for k in range(2):
+        orbit.flux[k] *= 2
+    orbit.compute_proper_error(update_sensitivity=False)
+    for k in range(2):
+        np.testing.assert_array_equal(orbit.error[k], error[k])
+    orbit.compute_proper_error()
+    for k in range(2):
+        np.testing.assert_allclose(orbit.error[k], 2 * error[k], rtol=1E-12)
+
+
+if __name__ == '__main__':
+    test_stis_plot_spectrum_range()
+    test_compute_proper_error_after_flux_edit()
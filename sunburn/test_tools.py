@@ -0,0 +1,90 @@
+from . import tools
+import numpy as np
+from scipy.interpolate import interp1d
+
+
+# Reference composite Simpson's rule, written as a plain loop. For an even
+# number of points it averages the two combinations of Simpson's rule and a
+# trapezoid at one of the ends, like ``simps(even='avg')`` did
+def _simpson_reference(y, x):
+    def basic(start, stop):
+        total = 0.0
+        for i in range(start, stop - 1, 2):
+            h0 = x[i + 1] - x[i]
+            h1 = x[i + 2] - x[i + 1]
+            h_sum = h0 + h1
+            total += h_sum / 6 * ((2 - h1 / h0) * y[i] +
+                                  h_sum ** 2 / (h0 * h1) * y[i + 1] +
+                                  (2 - h0 / h1) * y[i + 2])
+        return total
+
+    n = len(x)
+    if n == 2:
+        return 0.5 * (x[1] - x[0]) * (y[0] + y[1])
+    elif n % 2 == 1:
+        return basic(0, n - 1)
+    else:
+        first = basic(0, n - 2) + 0.5 * (x[-1] - x[-2]) * (y[-1] + y[-2])
+        last = basic(1, n - 1) + 0.5 * (x[1] - x[0]) * (y[0] + y[1])
+        return (first + last) / 2
+
+
+# Simpson's rule weights on uniform and non-uniform grids
+def test_simpson_weights():
+    rng = np.random.default_rng(42)
+    for n in range(2, 7):
+        uniform = np.linspace(1200.0, 1201.0, n)
+        non_uniform = np.sort(rng.uniform(1200.0, 1201.0, n))
+        for x in (uniform, non_uniform):
+            y = rng.normal(size=n)
+            weights = tools.simpson_weights(x)
+            assert len(weights) == n
+            assert np.isclose(weights @ y, _simpson_reference(y, x),
+                              rtol=1E-12, atol=0)
+
+
+# Linear interpolation with linear extrapolation outside of the sample points
+def test_linear_interpolation():
+    rng = np.random.default_rng(42)
+    xp = np.sort(rng.uniform(1200.0, 1201.0, 20))
+    fp = rng.normal(size=20)
+    reference = interp1d(xp, fp, fill_value='extrapolate')
+    inside = np.linspace(xp[0], xp[-1], 50)
+    outside = np.concatenate((np.linspace(1199.0, xp[0] - 1E-3, 10),
+                              np.linspace(xp[-1] + 1E-3, 1202.0, 10)))
+    for x in (inside, outside):
+        assert np.allclose(tools.linear_interpolation(x, xp, fp),
+                           reference(x), rtol=1E-12, atol=1E-12)
+
+
+# Analytic Jacobian of the Gaussian against central finite differences
+def test_gaussian_jacobian():
+    x = np.linspace(-50.0, 50.0, 101)
+    params = np.array([3.0, 8.0, 20.0])
+    step = 1E-6
+    numerical = np.empty((len(x), 3))
+    for k in range(3):
+        dp = np.zeros(3)
+        dp[k] = step
+        numerical[:, k] = (tools.gaussian(x, *(params + dp)) -
+                           tools.gaussian(x, *(params - dp))) / (2 * step)
+    assert np.allclose(tools.gaussian_jacobian(x, *params), numerical,
+                       rtol=1E-6, atol=1E-8)
+
+
+# Fit of a Gaussian with uncertainties recovering known parameters
+def test_fit_gaussian_uncertainties():
+    x = np.linspace(-50.0, 50.0, 81)
+    params = np.array([3.0, 8.0, 20.0])
+    y = tools.gaussian(x, *params)
+    yerr = np.full_like(x, 0.1)
+    solution = tools.fit_gaussian(x, y, 0.0, 10.0, 15.0, yerr=yerr)
+    assert solution.success
+    assert np.allclose(solution.x, params, rtol=1E-6)
+
+
+if __name__ == '__main__':
+    test_simpson_weights()
+    test_linear_interpolation()
+    test_gaussian_jacobian()
+    test_fit_gaussian_uncertainties()
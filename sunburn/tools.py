@@ -9,24 +9,34 @@ import astropy.units as u
 import astropy.constants as c
 from astropy.stats import poisson_conf_interval
 from scipy.signal import correlate
-from scipy.optimize import curve_fit, minimize
+from scipy.optimize import curve_fit, least_squares
 from scipy.interpolate import interp1d
-from scipy.stats import binned_statistic
-from scipy.special import wofz
+from scipy.special import voigt_profile
+
+# Speed of light in km / s
+_LS_KMS = c.c.to(u.km / u.s).value
+
+# Constants used to compute normalized Voigt profiles
+_INV_SQRT_2 = 1 / np.sqrt(2)
+_SQRT_PI = np.sqrt(np.pi)
 
 
 def nearest_index(array, target_value):
     """
     Finds the index of a value in ``array`` that is closest to ``target_value``.
+    Several target values can be searched in a single call by passing them as
+    an array.
 
     Args:
-        array (``numpy.array``): Target array.
-        target_value (``float``): Target value.
+        array (``numpy.array``): Target array, sorted in increasing order.
+        target_value (``float`` or array-like): Target value(s).
 
     Returns:
-        index (``int``): Index of the value in ``array`` that is closest to
-            ``target_value``.
+        index (``int`` or ``numpy.array``): Index of the value in ``array``
+            that is closest to ``target_value``, or an array of indexes if
+            ``target_value`` is array-like.
     """
+    target_value = np.asarray(target_value)
     index = array.searchsorted(target_value)
     index = np.clip(index, 1, len(array) - 1)
     left = array[index - 1]
@@ -42,18 +52,20 @@ def pick_side(wavelength_array, wavelength_range):
 
     Args:
         wavelength_array (``numpy.array``): The wavelength array read from a
-            ``UVSpectrum`` object.
+            ``UVSpectrum`` object, or only the first and last wavelengths of
+            each side. The wavelengths are assumed to be increasing, so only
+            the first and last values of each side are used.
         wavelength_range (array-like): Upper and lower limit of wavelength.
 
     Returns:
         index (``int``): Index of the side (or chip) where the requested
             wavelength falls into.
     """
-    if wavelength_range[0] > np.min(wavelength_array[0]) and \
-            wavelength_range[1] < np.max(wavelength_array[0]):
+    if wavelength_range[0] > wavelength_array[0][0] and \
+            wavelength_range[1] < wavelength_array[0][-1]:
         index = 0
-    elif wavelength_range[0] > np.min(wavelength_array[1]) and \
-            wavelength_range[1] < np.max(wavelength_array[1]):
+    elif wavelength_range[0] > wavelength_array[1][0] and \
+            wavelength_range[1] < wavelength_array[1][-1]:
         index = 1
     else:
         raise ValueError('The requested wavelength range (%i-%i) is not '
@@ -63,6 +75,54 @@ def pick_side(wavelength_array, wavelength_range):
     return index
 
 
+def simpson_weights(x):
+    """
+    Computes the weights of the composite Simpson's rule for the (possibly
+    non-uniform) grid ``x``, such that ``np.dot(weights, y)`` is equal to
+    ``scipy.integrate.simps(y, x=x)``. When ``x`` has an even number of points,
+    the result is the average of the two possible combinations of Simpson's
+    rule and a trapezoid at one of the ends (the ``even='avg'`` option of
+    ``simps``).
+
+    Args:
+        x (``numpy.array``): Sample points.
+
+    Returns:
+        weights (``numpy.array``): Integration weights, with the same length as
+            ``x``.
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    dx = np.diff(x)
+    weights = np.zeros(n)
+
+    # Basic Simpson's rule applied to the points between start and stop, which
+    # must contain an even number of intervals. With fewer than three points
+    # there is nothing to add (and the slices below would wrap around)
+    def _add_simpson(w, start, stop, factor=1.0):
+        if stop - start < 3:
+            return
+        h0 = dx[start:stop - 1:2]
+        h1 = dx[start + 1:stop - 1:2]
+        h_sum = h0 + h1
+        w[start:stop - 2:2] += factor * h_sum / 6 * (2 - h1 / h0)
+        w[start + 1:stop - 1:2] += factor * h_sum ** 3 / (6 * h0 * h1)
+        w[start + 2:stop:2] += factor * h_sum / 6 * (2 - h0 / h1)
+
+    if n < 2:
+        pass
+    elif n % 2 == 1:
+        _add_simpson(weights, 0, n)
+    else:
+        # Simpson's rule on the first n - 1 points and a trapezoid at the end
+        _add_simpson(weights, 0, n - 1, 0.5)
+        weights[-2:] += 0.25 * dx[-1]
+        # A trapezoid at the start and Simpson's rule on the last n - 1 points
+        weights[:2] += 0.25 * dx[0]
+        _add_simpson(weights, 1, n, 0.5)
+    return weights
+
+
 def make_bins(array):
     """
     Transform an array (e.g., wavelengths) into a bin-array (bins of
@@ -74,11 +134,13 @@ def make_bins(array):
     Returns:
 
     """
-    bin_array = (array[:-1] + array[1:]) / 2
+    n = len(array)
+    bin_array = np.empty(n + 1, dtype=np.result_type(array, 0.5))
+    bin_array[:n - 1] = (array[:-1] + array[1:]) / 2
     spacing = bin_array[1] - bin_array[0]
-    bin_array -= spacing
-    bin_array = np.append(bin_array, bin_array[-1] + spacing)
-    bin_array = np.append(bin_array, bin_array[-1] + spacing)
+    bin_array[:n - 1] -= spacing
+    bin_array[n - 1] = bin_array[n - 2] + spacing
+    bin_array[n] = bin_array[n - 1] + spacing
     return bin_array
 
 
@@ -102,34 +164,35 @@ def cross_correlate(line, spectrum, wavelength_span=1 * u.angstrom,
     else:
         pass
 
-    def square(x, x0, width):
-        if (x0 - width / 2) < x <= (x0 + width / 2):
-            y = 1 / width
-        else:
-            y = 0
-        return y
-
     w0 = line.central_wavelength
     wl_width = (line.wavelength_range[1] -line.wavelength_range[0]) / 2
     dw = wavelength_span / 2
 
     # Find the interval where to compute the ccf
     ind = pick_side(spectrum.wavelength, [w0 - dw, w0 + dw])
-    min_wl = nearest_index(spectrum.wavelength[ind], w0 - dw)
-    max_wl = nearest_index(spectrum.wavelength[ind], w0 + dw)
-    mask = np.array([square(xk, w0, wl_width / mask_width_factor)
-                     for xk in spectrum.wavelength[ind][min_wl:max_wl]])
-
-    ccf = correlate(spectrum.flux[ind][min_wl:max_wl], mask, mode='same')
-    d_shift = (spectrum.wavelength[ind][min_wl:max_wl] - w0) / w0 * \
-        c.c.to(u.km / u.s).value
-
-    # Setting the initial guesses to fit a Gaussian to the CCF
-    mult_factor = 1E14
+    min_wl, max_wl = nearest_index(spectrum.wavelength[ind],
+                                   [w0 - dw, w0 + dw])
+
+    # The mask is a square function centered at w0
+    wavelength = spectrum.wavelength[ind][min_wl:max_wl]
+    mask_width = wl_width / mask_width_factor
+    inside = (w0 - mask_width / 2 < wavelength) & \
+        (wavelength <= w0 + mask_width / 2)
+    mask = inside / mask_width
+
+    # The mask is as long as the spectrum slice, so the FFT method is always
+    # cheaper than the direct sum. The flux is converted to double precision
+    # so that the FFT is not computed in single precision
+    flux = spectrum.flux[ind][min_wl:max_wl].astype(float)
+    ccf = correlate(flux, mask, mode='same', method='fft')
+    d_shift = (wavelength - w0) / w0 * _LS_KMS
+
+    # Setting the initial guesses to fit a Gaussian to the CCF. With the
+    # analytic Jacobian, the fit converges without rescaling the CCF
     ds_0 = 0
-    fwhm_0 = wl_width / w0 * c.c.to(u.km / u.s).value
-    ampl_0 = np.max(ccf) * mult_factor
-    coeff = fit_gaussian(d_shift, ccf * mult_factor, ds_0, fwhm_0, ampl_0)
+    fwhm_0 = wl_width / w0 * _LS_KMS
+    ampl_0 = np.max(ccf)
+    coeff = fit_gaussian(d_shift, ccf, ds_0, fwhm_0, ampl_0)
     return d_shift, ccf, coeff
 
 
@@ -142,6 +205,28 @@ def gaussian(x, center, width, amplitude=None):
         return term_1 * term_2
 
 
+def gaussian_jacobian(x, center, width, amplitude):
+    """
+    Computes the Jacobian of a non-normalized Gaussian with respect to its
+    center, width and amplitude.
+
+    Args:
+        x (``numpy.array``): Points where to evaluate the Jacobian.
+        center (``float``): Center of the Gaussian.
+        width (``float``): Standard deviation of the Gaussian.
+        amplitude (``float``): Amplitude of the Gaussian.
+
+    Returns:
+        jacobian (``numpy.array``): Array with shape ``(len(x), 3)`` containing
+            the derivatives with respect to the center, width and amplitude.
+    """
+    dx = x - center
+    exponential = np.exp(-dx ** 2 / (2 * width ** 2))
+    g = amplitude * exponential
+    return np.stack([g * dx / width ** 2, g * dx ** 2 / width ** 3,
+                     exponential], axis=1)
+
+
 def fit_gaussian(x, y, x_0, fwhm_0, amplitude_0, yerr=None):
     """
     Fit a Gaussian to the (x, y) curve, using as a first guess the values of the
@@ -160,25 +245,25 @@ def fit_gaussian(x, y, x_0, fwhm_0, amplitude_0, yerr=None):
         amplitude_f:
 
     """
-    # The function that defines a Gaussian
-    def local_gaussian(xs, p):
-        mu, sigma, ampl = p
-        return gaussian(xs, mu, sigma, ampl)
+    # The residuals of the fit normalized by the uncertainties, and their
+    # analytic Jacobian
+    def residuals(theta):
+        return (y - gaussian(x, *theta)) / yerr
 
-    def chisq(theta, x_obs, y_obs, err_obs):
-        model = local_gaussian(x_obs, theta)
-        return np.sum((y_obs - model) ** 2 / err_obs ** 2)
+    def residuals_jacobian(theta):
+        return -gaussian_jacobian(x, *theta) / np.reshape(yerr, (-1, 1))
 
     # The initial guess
     p0 = np.array([x_0, fwhm_0, amplitude_0])
 
     # Perform the fit
     if yerr is None:
-        coeff, var = curve_fit(gaussian, x, y, p0=p0)
+        coeff, var = curve_fit(gaussian, x, y, p0=p0, jac=gaussian_jacobian)
         return coeff, var
         #coeff, var = curve_fit(local_gaussian, x, y, p0=p0)
     else:
-        solution = minimize(chisq, x0=p0, args=(x, y, yerr))
+        solution = least_squares(residuals, p0, jac=residuals_jacobian,
+                                 method='lm')
         return solution
 
 
@@ -198,26 +283,75 @@ def doppler_shift(velocity, ref_wl, wavelength, flux, uncertainty,
     Returns:
 
     """
-    l_speed = c.c.to(u.km / u.s).value
     try:
         dv = velocity.to(u.km / u.s).value
     except AttributeError:
         dv = velocity
 
-    shift = dv / l_speed * ref_wl
-    old_wavelength = np.copy(wavelength)
-    old_flux = np.copy(flux)
-    old_error = np.copy(uncertainty)
-    new_wv = np.copy(wavelength) + shift
-    func0 = interp1d(new_wv, old_flux, kind=interp_type,
-                     fill_value=fill_value, bounds_error=False)
-    func1 = interp1d(new_wv, old_error, kind=interp_type,
-                     fill_value=fill_value, bounds_error=False)
-    new_flux = func0(old_wavelength)
-    new_uncertainty = func1(old_wavelength)
+    shift = dv / _LS_KMS * ref_wl
+    old_wavelength = np.asarray(wavelength)
+    old_flux = np.asarray(flux)
+    old_error = np.asarray(uncertainty)
+    new_wv = old_wavelength + shift
+
+    # For linear interpolation, the flux and uncertainty share the same
+    # intervals and weights, so they are computed only once
+    if interp_type == 'linear':
+        hi = np.clip(new_wv.searchsorted(old_wavelength), 1, len(new_wv) - 1)
+        lo = hi - 1
+        x_diff = old_wavelength - new_wv[lo]
+        x_span = new_wv[hi] - new_wv[lo]
+        new_flux = (old_flux[hi] - old_flux[lo]) / x_span * x_diff + \
+            old_flux[lo]
+        new_uncertainty = (old_error[hi] - old_error[lo]) / x_span * x_diff + \
+            old_error[lo]
+        if isinstance(fill_value, str) and fill_value == 'extrapolate':
+            pass
+        else:
+            outside = (old_wavelength < new_wv[0]) | \
+                (old_wavelength > new_wv[-1])
+            new_flux[outside] = fill_value
+            new_uncertainty[outside] = fill_value
+    else:
+        func0 = interp1d(new_wv, old_flux, kind=interp_type,
+                         fill_value=fill_value, bounds_error=False)
+        func1 = interp1d(new_wv, old_error, kind=interp_type,
+                         fill_value=fill_value, bounds_error=False)
+        new_flux = func0(old_wavelength)
+        new_uncertainty = func1(old_wavelength)
     return new_flux, new_uncertainty
 
 
+# Linear interpolation with linear extrapolation
+def linear_interpolation(x, xp, fp):
+    """
+    Linearly interpolates the values ``fp``, sampled at the increasing points
+    ``xp``, to the points ``x``. Outside of the range of ``xp``, the values are
+    linearly extrapolated from the first or last two points. This is the same
+    as ``scipy.interpolate.interp1d(xp, fp, fill_value='extrapolate')(x)``, but
+    without building an interpolator object.
+
+    Args:
+        x (``numpy.array``): Points where to evaluate the interpolation.
+        xp (``numpy.array``): Increasing sample points.
+        fp (``numpy.array``): Values at the sample points.
+
+    Returns:
+        y (``numpy.array``): Interpolated values.
+    """
+    x = np.asarray(x)
+    y = np.interp(x, xp, fp)
+    below = x < xp[0]
+    if np.any(below):
+        slope = (fp[1] - fp[0]) / (xp[1] - xp[0])
+        y[below] = fp[0] + slope * (x[below] - xp[0])
+    above = x > xp[-1]
+    if np.any(above):
+        slope = (fp[-1] - fp[-2]) / (xp[-1] - xp[-2])
+        y[above] = fp[-1] + slope * (x[above] - xp[-1])
+    return y
+
+
 # Bin a spectrum to a specific Doppler shift width
 def bin_spectrum(bin_width, wavelength, doppler_shift, flux, flux_uncertainty,
                  final_uncertainty='combine'):
@@ -238,20 +372,32 @@ def bin_spectrum(bin_width, wavelength, doppler_shift, flux, flux_uncertainty,
     f = flux
     u = flux_uncertainty
     v_bins = np.arange(min(ds), max(ds) + bw, bw)
-
-    binned_data, edges, inds = binned_statistic(ds, [wv, ds, f], bins=v_bins,
-                                                statistic='mean')
-    wv_bin = binned_data[0]
-    v_bin = binned_data[1]
-    f_bin = binned_data[2]
+    n_bins = len(v_bins) - 1
+
+    # Find the bin of each point only once. As in
+    # ``scipy.stats.binned_statistic``, points that fall on the rightmost edge
+    # (up to a rounding precision) belong to the last bin
+    ds = np.asarray(ds)
+    inds = np.searchsorted(v_bins, ds, side='right') - 1
+    decimal = int(-np.log10(np.min(np.diff(v_bins)))) + 6
+    on_edge = (ds >= v_bins[-1]) & \
+        (np.around(ds, decimal) == np.around(v_bins[-1], decimal))
+    inds[on_edge] -= 1
+    valid = (inds >= 0) & (inds < n_bins)
+    inds = inds[valid]
+
+    # The mean in each bin, which is NaN for empty bins
+    counts = np.bincount(inds, minlength=n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wv_bin = np.bincount(inds, np.asarray(wv)[valid], n_bins) / counts
+        v_bin = np.bincount(inds, ds[valid], n_bins) / counts
+        f_bin = np.bincount(inds, np.asarray(f)[valid], n_bins) / counts
 
     # Combine uncertainties assuming Gaussian regime
     if final_uncertainty == 'combine':
-        u_bin, edges, inds = binned_statistic(ds, u ** 2, bins=v_bins,
-                                              statistic='sum')
-        u_count, edges, inds = binned_statistic(ds, u ** 2, bins=v_bins,
-                                                statistic='count')
-        u_bin = u_bin ** 0.5 / u_count ** 0.5
+        u_bin = np.bincount(inds, np.asarray(u)[valid] ** 2, n_bins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            u_bin = u_bin ** 0.5 / counts ** 0.5
     elif final_uncertainty == 'poisson':
         confidence_interval = poisson_conf_interval(f_bin)
         u_bin = np.mean(confidence_interval, axis=0)
@@ -285,28 +431,24 @@ def combine_spectra(wavelength_list, flux_list, uncertainty_list,
     else:
         wavelength = wavelength_grid
 
-    flux = []
-    f_unc = []
+    wavelength = np.array(wavelength)
+    flux = np.empty((n_spectra, len(wavelength)))
+    f_unc = np.empty_like(flux)
     for i in range(n_spectra):
-        # First interpolate the spectrum to the wavelength grid
-        ff = interp1d(wavelength_list[i], flux_list[i], kind='linear',
-                      bounds_error=False, fill_value=1E-18)
-        fu = interp1d(wavelength_list[i], uncertainty_list[i], kind='linear',
-                      bounds_error=False, fill_value=1E-18)
+        # Interpolate the spectrum to the wavelength grid, directly into the
+        # rows of the arrays of interpolated spectra
+        flux[i] = np.interp(wavelength, wavelength_list[i], flux_list[i],
+                            left=1E-18, right=1E-18)
+        f_unc[i] = np.interp(wavelength, wavelength_list[i],
+                             uncertainty_list[i], left=1E-18, right=1E-18)
 
-        # Add them to the lists of interpolated arrays
-        flux.append(ff(wavelength))
-        f_unc.append(fu(wavelength))
-
-    wavelength = np.array(wavelength)
-    flux = np.mean(np.array(flux), axis=0)
-    f_unc = (np.sum(np.array(f_unc) ** 2, axis=0)) ** 0.5 / n_spectra
+    flux = np.mean(flux, axis=0)
+    f_unc = np.sqrt(np.einsum('ij,ij->j', f_unc, f_unc)) / n_spectra
 
     # If a reference wavelength was provided, calculate the Doppler
     # velocities
     if ref_wavelength is not None:
-        velocity = (wavelength - ref_wavelength) / ref_wavelength * \
-                   c.c.to(u.km / u.s).value
+        velocity = (wavelength - ref_wavelength) / ref_wavelength * _LS_KMS
         return wavelength, velocity, flux, f_unc
     else:
         return wavelength, flux, f_unc
@@ -323,5 +465,7 @@ def norm_voigt(a, u):
     Returns:
 
     """
-    z = u + 1j * a
-    return wofz(z).real
+    # The real part of the Faddeeva function w(u + ia) is a Voigt profile
+    # with sigma = 1 / sqrt(2) and gamma = a, up to a factor of sqrt(pi). This
+    # avoids building the complex argument and output arrays of ``wofz``
+    return voigt_profile(u, _INV_SQRT_2, a) * _SQRT_PI